@@ -21,6 +21,54 @@ if 'VCAP_SERVICES' in os.environ:
 SQLALCHEMY_DATABASE_URI = DATABASE_URI
 SQLALCHEMY_TRACK_MODIFICATIONS = False
 
+# Optional read replicas, comma separated. GET requests are spread over them
+# round-robin except for clients that wrote within the read-your-writes window
+REPLICA_DATABASE_URIS = [uri.strip() for uri in os.getenv("REPLICA_DATABASE_URIS", "").split(",") if uri.strip()]
+READ_YOUR_WRITES_SECONDS = float(os.getenv("READ_YOUR_WRITES_SECONDS", "5"))
+
+# Connection pool of every worker, size it against the number of gunicorn workers
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "true").lower() in ("1", "true", "yes")
+
+# Paging of the order list
+PAGE_SIZE = int(os.getenv("PAGE_SIZE", "100"))
+MAX_PAGE_SIZE = int(os.getenv("MAX_PAGE_SIZE", "1000"))
+
+# Largest number of orders accepted by POST /orders/batch
+MAX_BATCH_SIZE = int(os.getenv("MAX_BATCH_SIZE", "10000"))
+
+# Largest number of ids accepted by POST /orders/lookup
+MAX_LOOKUP_SIZE = int(os.getenv("MAX_LOOKUP_SIZE", "5000"))
+
+# Number of orders fetched per round trip by the streaming export
+EXPORT_BATCH_SIZE = int(os.getenv("EXPORT_BATCH_SIZE", "1000"))
+
+# How long the response to a POST /orders with an Idempotency-Key is replayed
+IDEMPOTENCY_KEY_TTL = int(os.getenv("IDEMPOTENCY_KEY_TTL", "86400"))
+
+# Days the tombstones of deleted orders are kept for GET /orders?updated_since=
+TOMBSTONE_RETENTION_DAYS = int(os.getenv("TOMBSTONE_RETENTION_DAYS", "30"))
+
+# Days the change events of the outbox are kept for GET /events
+EVENT_RETENTION_DAYS = int(os.getenv("EVENT_RETENTION_DAYS", "7"))
+
+# Seconds between two reads of the outbox head while requests wait for new events
+EVENT_POLL_SECONDS = float(os.getenv("EVENT_POLL_SECONDS", "1"))
+
+# Longest wait of GET /events and longest life of a GET /events/stream response
+EVENT_STREAM_SECONDS = float(os.getenv("EVENT_STREAM_SECONDS", "30"))
+
+# Requests of a worker that may wait for events at once, keep it below the threads of the Procfile
+EVENT_MAX_WAITERS = int(os.getenv("EVENT_MAX_WAITERS", "4"))
+
+# Read-through cache of serialized orders, any service.cache.CacheBackend can be named here
+ORDER_CACHE_BACKEND = os.getenv("ORDER_CACHE_BACKEND", "service.cache.LRUCache")
+ORDER_CACHE_SIZE = int(os.getenv("ORDER_CACHE_SIZE", "1024"))
+ORDER_CACHE_TTL = float(os.getenv("ORDER_CACHE_TTL", "30"))
+
 # Secret for session management
 SECRET_KEY = os.getenv("SECRET_KEY", "s3cr3t-key-shhhh")
 
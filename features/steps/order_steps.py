@@ -31,13 +31,9 @@ from compare import expect
 def step_impl(context):
     """ Delete all Order and load new ones """
     headers = {'Content-Type': 'application/json'}
-    # list all of the orders and delete them one by one
-    context.resp = requests.get(context.base_url + '/orders')
-    # context.resp = requests.get(context.base_url + '/orders', headers=headers)
+    # delete all of the orders with a single request
+    context.resp = requests.delete(context.base_url + '/orders?all=true')
     expect(context.resp.status_code).to_equal(200)
-    for order in context.resp.json():
-        context.resp = requests.delete(context.base_url + '/orders/' + str(order["id"]), headers=headers)
-        expect(context.resp.status_code).to_equal(204)
     
     # load the database with new orders
     create_url = context.base_url + '/orders'
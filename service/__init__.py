@@ -15,7 +15,7 @@ app = Flask(__name__)
 app.config.from_object("config")
 
 # Import the routes After the Flask app is created
-from service import routes
+from service import routes, commands
 
 # # Set up logging for production
 if __name__ != "__main__":
@@ -0,0 +1,120 @@
+"""
+Order Cache
+
+Read-through cache for serialized Orders
+
+The backend is chosen with the ORDER_CACHE_BACKEND setting. The default
+LRUCache lives inside each worker process, any other CacheBackend (for
+example one backed by a server that every worker talks to) can be
+plugged in by its import path. Cached values are JSON compatible
+dictionaries so they can be stored outside of the process.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+from werkzeug.utils import import_string
+
+
+def create_cache(config):
+    """ Creates the cache backend named in the configuration """
+    backend = import_string(config["ORDER_CACHE_BACKEND"])
+    return backend.from_config(config)
+
+
+class CacheBackend:
+    """ Interface every order cache backend implements """
+
+    @classmethod
+    def from_config(cls, config):
+        """ Creates the backend from the application configuration """
+        return cls()
+
+    def get(self, key):
+        """ Returns the value stored under key or None """
+        raise NotImplementedError
+
+    def set(self, key, value):
+        """ Stores a value under key """
+        raise NotImplementedError
+
+    def delete(self, key):
+        """ Removes key if it is cached """
+        raise NotImplementedError
+
+    def clear(self):
+        """ Removes every cached value """
+        raise NotImplementedError
+
+    def stats(self):
+        """ Returns the hit, miss and eviction counters """
+        raise NotImplementedError
+
+
+class LRUCache(CacheBackend):
+    """
+    In-process least recently used cache whose entries expire after ttl seconds
+
+    Every worker has its own copy so a write only invalidates the cache of
+    the worker that served it, the ttl bounds how stale the others can be.
+    """
+
+    def __init__(self, maxsize=1024, ttl=30, clock=time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.clock = clock
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(maxsize=config["ORDER_CACHE_SIZE"], ttl=config["ORDER_CACHE_TTL"])
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            expires, value = entry
+            if expires <= self.clock():
+                del self._entries[key]
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (self.clock() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "maxsize": self.maxsize,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+            }
@@ -0,0 +1,108 @@
+"""
+Management commands
+
+Run them with the flask command line, e.g.:
+    FLASK_APP=service:app flask rebuild-stats
+"""
+import json
+import time
+import timeit
+import tracemalloc
+from datetime import datetime, timedelta
+from decimal import Decimal
+
+import click
+from flask_restx import marshal
+
+from service import app, records
+from service.models import db, Order, OrderEvent, OrderItem, OrderTombstone
+from service.routes import order_model, order_serializer
+from service.serializers import dumps, orjson
+
+
+@app.cli.command("rebuild-stats")
+def rebuild_stats():
+    """Recomputes the order totals and the sales rollups from the order items"""
+    customers, days = Order.rebuild_rollups()
+    click.echo(f"Rebuilt the sales rollups of {customers} customers and {days} days")
+
+
+@app.cli.command("purge-tombstones")
+@click.option("--days", type=int, default=None,
+              help="Keep the tombstones of this many days, TOMBSTONE_RETENTION_DAYS by default")
+def purge_tombstones(days):
+    """Removes the tombstones of deleted orders that are past their retention"""
+    if days is None:
+        days = app.config["TOMBSTONE_RETENTION_DAYS"]
+    count = OrderTombstone.purge(datetime.utcnow() - timedelta(days=days))
+    click.echo(f"Purged {count} tombstones older than {days} days")
+
+
+@app.cli.command("purge-events")
+@click.option("--days", type=int, default=None,
+              help="Keep the events of this many days, EVENT_RETENTION_DAYS by default")
+def purge_events(days):
+    """Removes the change events of the outbox that are past their retention"""
+    if days is None:
+        days = app.config["EVENT_RETENTION_DAYS"]
+    count = OrderEvent.purge(datetime.utcnow() - timedelta(days=days))
+    click.echo(f"Purged {count} events older than {days} days")
+
+
+@app.cli.command("benchmark-serializers")
+@click.option("--orders", type=int, default=10000, help="Number of Orders in the response")
+@click.option("--items", type=int, default=3, help="Number of items of each Order")
+@click.option("--repeat", type=int, default=5, help="Runs of each serializer, the fastest one counts")
+def benchmark_serializers(orders, items, repeat):
+    """Times the order list serialization with flask-restx marshal() and with the compiled serializer"""
+    now = datetime.utcnow()
+    batch = []
+    for order_id in range(1, orders + 1):
+        order = Order(id=order_id, customer_id=order_id % 97, date_order=now, updated_at=now, version=1,
+                      total_amount=Decimal("37.50"), item_count=items, unit_count=items * 3)
+        order.items = [OrderItem(id=order_id * items + line, product_id=line, product_price=Decimal("12.50"),
+                                 product_quantity=3) for line in range(items)]
+        batch.append(order)
+    serialize = order_serializer()
+    runs = {
+        "marshal": lambda: json.dumps(marshal([order.serialize() for order in batch], order_model)).encode(),
+        "compiled": lambda: dumps([serialize(order) for order in batch]),
+    }
+    if runs["marshal"]() != json.dumps(json.loads(runs["compiled"]())).encode():
+        raise click.ClickException("The compiled serializer does not match marshal()")
+    seconds = {name: min(timeit.repeat(run, number=1, repeat=repeat)) for name, run in runs.items()}
+    click.echo(f"Serialized {orders} orders of {items} items, JSON backend: {'orjson' if orjson else 'json'}")
+    for name, elapsed in seconds.items():
+        click.echo(f"{name:>9}: {elapsed * 1000:9.1f} ms")
+    click.echo(f"  speedup: {seconds['marshal'] / seconds['compiled']:9.1f}x")
+
+
+@app.cli.command("benchmark-read-model")
+@click.option("--limit", type=int, default=100000, help="Number of stored Orders to list")
+def benchmark_read_model(limit):
+    """Lists the stored Orders through the ORM and through the Core records, compares CPU and peak memory"""
+    serialize = order_serializer()
+
+    def orm():
+        orders = Order.paginate(Order.search(), limit).all()[:limit]
+        return dumps([serialize(order) for order in Order.load_items(orders)])
+
+    def core():
+        orders, _ = records.page({}, limit)
+        return dumps([serialize(order) for order in records.load_items(orders)])
+
+    click.echo(f"Listing up to {limit} orders with their items")
+    for name, run in (("orm", orm), ("records", core)):
+        db.session.remove()  # each run starts with an empty identity map
+        start = time.process_time()
+        body = run()
+        elapsed = time.process_time() - start
+        db.session.remove()
+        tracemalloc.start()
+        run()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        db.session.remove()
+        orders = len(json.loads(body))
+        click.echo(f"{name:>8}: {elapsed * 1000:9.1f} ms CPU, {elapsed * 1e6 / max(orders, 1):6.1f} us per order, "
+                   f"{peak / 2**20:7.1f} MiB peak")
@@ -0,0 +1,79 @@
+"""
+Event Waiters
+
+Lets the requests that wait for Order change events share one reader
+
+A request to GET /events?wait= or GET /events/stream holds a worker
+thread while it waits. The waiting requests of a process take one of
+EVENT_MAX_WAITERS slots so they can never hold every thread, the others
+are answered 503. A single poller thread reads the head of the outbox
+every EVENT_POLL_SECONDS and wakes the waiters when it moves, instead of
+every waiter querying the database. The poller stops once nobody waits.
+"""
+import threading
+import time
+
+from service import app
+from service.models import db, OrderEvent
+
+logger = app.logger
+
+
+class EventWaiters:
+    """ The waiting slots of a process and the poller that wakes them """
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._waiting = 0
+        self._polling = False
+        self.head = None
+
+    def acquire(self, app):
+        """ Takes a waiting slot and starts the poller, returns False when they are all taken """
+        with self._condition:
+            if self._waiting >= app.config["EVENT_MAX_WAITERS"]:
+                return False
+            self._waiting += 1
+            if not self._polling:
+                self._polling = True
+                threading.Thread(target=self._poll, args=(app,), name="event-poller", daemon=True).start()
+            return True
+
+    def release(self):
+        """ Gives a waiting slot back """
+        with self._condition:
+            self._waiting -= 1
+
+    def wait_past(self, position, timeout):
+        """ Blocks until the outbox head is past an outbox position, returns it or None after the timeout """
+        with self._condition:
+            if self._condition.wait_for(lambda: self.head is not None and self.head > position, timeout):
+                return self.head
+            return None
+
+    def stats(self):
+        """ Returns the number of waiting requests and the last head read """
+        with self._condition:
+            return {"waiting": self._waiting, "head": self.head}
+
+    def _poll(self, app):
+        """ Reads the outbox head until nobody waits any more """
+        with app.app_context():
+            while True:
+                with self._condition:
+                    if not self._waiting:
+                        self._polling = False
+                        return
+                try:
+                    head = OrderEvent.head()
+                except Exception as error:
+                    # the poller must keep running, the waiters would otherwise sleep out their wait
+                    logger.warning("Could not read the outbox head: %s", error)
+                    head = self.head
+                finally:
+                    db.session.remove()  # no connection is held between two reads
+                with self._condition:
+                    if head != self.head:
+                        self.head = head
+                        self._condition.notify_all()
+                time.sleep(app.config["EVENT_POLL_SECONDS"])
@@ -3,20 +3,79 @@ Models for orders
 
 All of the models are stored in this module
 """
-from datetime import datetime
+from datetime import date, datetime, time, timedelta
+from decimal import Decimal, InvalidOperation
+from hashlib import sha256
+from collections import defaultdict
+from itertools import cycle
+import json
 import logging
+import threading
+import time as timer
+from types import SimpleNamespace
 
-from flask_sqlalchemy import SQLAlchemy
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
 # from SQLAlchemy import func
-from sqlalchemy import and_, func
+from sqlalchemy import and_, bindparam, case, create_engine, false, func, or_, select, text, true, tuple_, union_all
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import joinedload, selectinload, sessionmaker
+from sqlalchemy.orm.attributes import set_committed_value
+from werkzeug.exceptions import NotFound
 
 from . import app
+from .cache import create_cache
+from .pool import engine_options
 
 # logger = logging.getLogger("flask.app")
 logger = app.logger
 
+class RoutingSession(SignallingSession):
+    """ Session that sends its reads to a replica database while one is selected """
+
+    replica = None
+
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        if self.replica is not None and not self._flushing:
+            return self.replica
+        return super().get_bind(mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """ SQLAlchemy whose sessions can be routed to a replica """
+
+    def create_session(self, options):
+        return sessionmaker(class_=RoutingSession, db=self, **options)
+
+
 # Create the SQLAlchemy object to be initialized later in init_db()
-db = SQLAlchemy()
+db = RoutingSQLAlchemy()
+
+# Maximum number of rows sent in one multi-row INSERT statement
+BULK_INSERT_CHUNK = 1000
+
+# Number of orders written per transaction by Order.create_many()
+BATCH_CREATE_CHUNK = 500
+
+# Date formats accepted by the date filters
+DATE_FORMATS = ("%Y-%m-%d", "%m/%d/%Y")
+
+# Precision of OrderItem.product_price, used when comparing incoming prices
+PRICE_QUANTUM = Decimal("0.01")
+
+# Range of the Integer columns of order_header and order_item
+INTEGER_MIN = -2 ** 31
+INTEGER_MAX = 2 ** 31 - 1
+
+# Largest product_price and total_amount their DECIMAL(10, 2) and DECIMAL(12, 2) columns hold
+PRICE_MAX = Decimal("99999999.99")
+TOTAL_MAX = Decimal("9999999999.99")
+
+# Seconds between two sweeps of the expired idempotency keys
+PURGE_INTERVAL = 60
+
+# Longest Idempotency-Key that is stored
+IDEMPOTENCY_KEY_LENGTH = 255
 
 
 def init_db(app):
@@ -24,22 +83,95 @@ def init_db(app):
     Order.init_db(app)
 
 
+def json_default(value):
+    """ Encodes the dates and decimals of a serialized model as JSON strings """
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    return str(value)
+
+
 class DataValidationError(Exception):
     """ Used for a data validation errors when deserializing """
 
     pass
 
 
+class VersionConflictError(Exception):
+    """ Used when an Order is no longer at the version a write was based on """
+
+    pass
+
+
+def parse_date(value):
+    """
+    Returns the calendar day of a date, a datetime or a date string
+
+    Strings may be ISO 8601 (2022-02-21) or US style (02/21/2022)
+    """
+    if isinstance(value, datetime):
+        return value.date()
+    if isinstance(value, date):
+        return value
+    for date_format in DATE_FORMATS:
+        try:
+            return datetime.strptime(str(value), date_format).date()
+        except ValueError:
+            pass
+    raise DataValidationError(f"Invalid date: {value}")
+
+
+def parse_datetime(value):
+    """ Returns a datetime from a datetime, a date or a date string """
+    if isinstance(value, datetime):
+        return value
+    try:
+        return datetime.fromisoformat(str(value))
+    except ValueError:
+        return datetime.combine(parse_date(value), time.min)
+
+
+def insert_chunked(table, rows):
+    """ Inserts rows into a table with multi-row INSERTs of BULK_INSERT_CHUNK rows, does not commit """
+    for start in range(0, len(rows), BULK_INSERT_CHUNK):
+        db.session.execute(table.insert().values(rows[start:start + BULK_INSERT_CHUNK]))
+
+
 class Order(db.Model):
     """
     Class that represents a <your resource model name>
     """
     app = None
+    cache = None  # read-through cache of serialized orders, set by init_db
+    replicas = []  # engines of the read replicas, set by init_replicas
+    _replica_cycle = None
 
     # Table Schema
     id = db.Column(db.Integer, primary_key=True)
-    date_order = db.Column(db.DateTime(), default=datetime.now)
+    date_order = db.Column(db.DateTime(), default=datetime.now, index=True)
     customer_id = db.Column(db.Integer, nullable=False)
+    # Bumped whenever the order or one of its items changes
+    version = db.Column(db.Integer, nullable=False, default=1)
+    updated_at = db.Column(db.DateTime(), nullable=False, default=datetime.utcnow)
+    # Derived from the items in the transaction that writes them
+    total_amount = db.Column(db.DECIMAL(12, 2), nullable=False, default=0)
+    item_count = db.Column(db.Integer, nullable=False, default=0)
+    unit_count = db.Column(db.Integer, nullable=False, default=0)
+
+    # Customer searches are paged by id so both live in one index, as do
+    # the sort columns of the order list and the modification time read by
+    # the delta feed
+    __table_args__ = (
+        db.Index("ix_order_customer_id_id", "customer_id", "id"),
+        db.Index("ix_order_updated_at_id", "updated_at", "id"),
+        db.Index("ix_order_total_amount_id", "total_amount", "id"),
+        db.Index("ix_order_item_count_id", "item_count", "id"),
+    )
+
+    # Columns the order list can be sorted by, the id breaks ties
+    SORT_COLUMNS = ("total_amount", "item_count")
+
+    # Header columns of the serialized order, clients can ask for some of them
+    FIELDS = ("id", "date_order", "customer_id", "total_amount", "item_count", "unit_count", "updated_at")
 
     # Relationship
     items = db.relationship("OrderItem", back_populates="order", cascade="all, delete", passive_deletes=True)
@@ -47,59 +179,294 @@ class Order(db.Model):
     def __repr__(self):
         return f"<order id=[{self.id}]>"
 
-    def create(self):
+    def create(self, idempotency_key=None):
         """
-        Creates an order_header in the database
-        orders = Order.all()
+        Creates an order_header and its items in a single transaction
+
+        The items in item_list are written with multi-row INSERT statements
+        so nothing is committed unless the whole order can be stored. An
+        IdempotencyKey passed in is stored in the same transaction.
         """
         logger.info("Creating %s", self)
         # todo: Change id to id
         self.id = None  # id must be none to generate next primary key
-        db.session.add(self)
-        db.session.commit()
-        app.logger.debug("Creating order")
-        if hasattr(self, 'item_list'):
-            for item in self.item_list:
-                order_item = OrderItem()
-                item['order_id'] = self.id
-                order_item.deserialize(item)
-                order_item.create()
+        item_list = getattr(self, 'item_list', None) or []
+        rows = [OrderItem.normalize(OrderItem.extract(item)) for item in item_list]
+        self.total_amount, self.item_count, self.unit_count = Order.totals(rows)
+        try:
+            db.session.add(self)
+            db.session.flush()  # assigns the primary key without committing
+            order_id = self.id
+            OrderItem.bulk_insert(order_id, rows)
+            Order.rollup(added=Order.contributions(Order.id == order_id))
+            OrderEvent.record("created", [order_id])
+            if idempotency_key is not None:
+                idempotency_key.remember(self)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        Order.invalidate(order_id)
+        app.logger.debug("Created order %s with %d items", order_id, len(rows))
 
-    def update(self):
+    def update(self, expected_version=None):
         """
         Updates an Order in the database
-        """
-        logger.info("Saving %s", self.id)
-        if not self.id:
-            raise DataValidationError("Update called with empty ID field")
-        db.session.commit()
 
-        for item in self.items:
-            item.delete()
+        The stored items are reconciled with item_list so only the lines
+        that were added, changed or removed are written, all in a single
+        transaction. Returns the number of item rows touched by kind.
 
-        if hasattr(self, 'item_list'):
-            for item in self.item_list:
-                order_item = OrderItem()
-                item['order_id'] = self.id
-                order_item.deserialize(item)
-                order_item.create()
+        With expected_version the write is a compare-and-set: it raises
+        VersionConflictError and changes nothing unless the stored Order
+        still is at that version.
+        """
+        item_list = getattr(self, 'item_list', None) or []
+        try:
+            # the rollups need the row as it is stored, before these changes
+            with db.session.no_autoflush:
+                logger.info("Saving %s", self.id)
+                if not self.id:
+                    raise DataValidationError("Update called with empty ID field")
+                stored = Order.bump_version(self.id, expected_version)
+                set_committed_value(self, "version", stored.version)
+                set_committed_value(self, "updated_at", stored.updated_at)
+                # the reconciled items are exactly the ones in item_list
+                self.total_amount, self.item_count, self.unit_count = Order.totals(
+                    [OrderItem.normalize(OrderItem.extract(item)) for item in item_list]
+                )
+            db.session.flush()
+            changes = OrderItem.reconcile(self.id, item_list)
+            Order.rollup([stored], Order.contributions(Order.id == self.id))
+            OrderEvent.record("updated", [self.id])
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        Order.invalidate(self.id)
+        logger.info(
+            "Order %s items reconciled: %d inserted, %d updated, %d deleted",
+            self.id, changes["inserted"], changes["updated"], changes["deleted"]
+        )
+        return changes
 
     def delete(self):
         """ Removes an order_header from the data store """
         logger.info("Deleting %s", self.id)
-        db.session.delete(self)
-        db.session.commit()
+        try:
+            Order.rollup(removed=Order.contributions(Order.id == self.id, lock=True))
+            OrderTombstone.bury([self.id])
+            OrderEvent.record("deleted", [self.id])
+            db.session.delete(self)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        Order.invalidate(self.id)
 
-    def serialize(self):
-        """ Serializes an order_header into a dictionary """
+    @classmethod
+    def create_many(cls, data_list):
+        """
+        Creates many orders with multi-row INSERT statements
+
+        The orders are written BATCH_CREATE_CHUNK at a time with one
+        transaction per chunk. Returns one result per element of data_list,
+        either {"id": ...} or {"error": ...}.
+        """
+        logger.info("Creating %d orders", len(data_list))
+        results = [None] * len(data_list)
+        valid = []
+        for index, data in enumerate(data_list):
+            try:
+                valid.append((index,) + cls.batch_row(data))
+            except DataValidationError as error:
+                results[index] = {"error": str(error)}
+
+        for start in range(0, len(valid), BATCH_CREATE_CHUNK):
+            chunk = valid[start:start + BATCH_CREATE_CHUNK]
+            try:
+                ids = cls.store_chunk(chunk)
+                db.session.commit()
+            except SQLAlchemyError as error:
+                db.session.rollback()
+                logger.warning("Storing %d orders one at a time after: %s", len(chunk), error)
+                ids = cls.store_each(chunk, results)
+            for order_id, (index, _, _) in zip(ids, chunk):
+                if order_id is not None:
+                    results[index] = {"id": order_id}
+        return results
+
+    @classmethod
+    def store_chunk(cls, chunk):
+        """ Inserts the (index, header, items) of validated orders and returns their ids, does not commit """
+        ids = cls.insert_headers([header for _, header, _ in chunk])
+        OrderItem.insert_rows([
+            dict(item, order_id=order_id)
+            for order_id, (_, _, items) in zip(ids, chunk) for item in items
+        ])
+        cls.rollup(added=cls.contributions(cls.id.in_(ids)))
+        OrderEvent.record("created", ids)
+        return ids
+
+    @classmethod
+    def store_each(cls, chunk, results):
+        """
+        Stores the orders of a chunk that failed as a whole, each in a SAVEPOINT
+
+        The orders the database still refuses get their error in results
+        and the others are committed together. Returns the ids in chunk
+        order with None for the orders that were not stored.
+        """
+        ids = []
+        for index, header, items in chunk:
+            try:
+                with db.session.begin_nested():
+                    ids.extend(cls.store_chunk([(index, header, items)]))
+            except SQLAlchemyError as error:
+                logger.error("Could not store order: %s", error)
+                ids.append(None)
+                results[index] = cls.store_error(error)
+        try:
+            db.session.commit()
+        except SQLAlchemyError as error:
+            db.session.rollback()
+            logger.error("Could not store orders: %s", error)
+            for index, _, _ in chunk:
+                results[index] = results[index] or cls.store_error(error)
+            return [None] * len(chunk)
+        return ids
+
+    @staticmethod
+    def store_error(error):
+        """ Returns the batch result of an order the database refused """
+        return {"error": "Could not store order: " + str(getattr(error, "orig", error)).strip()}
+
+    @staticmethod
+    def batch_row(data):
+        """
+        Validates an order dictionary and returns its header values and item rows
+
+        Args:
+            data (dict): A dictionary containing the resource data
+        """
+        try:
+            header = {"customer_id": int(data["customer_id"]), "date_order": parse_datetime(data["date_order"])}
+            item_list = data.get("item_list") or []
+            rows = [OrderItem.normalize(OrderItem.extract(item)) for item in item_list]
+        except KeyError as error:
+            raise DataValidationError(
+                "Invalid order_header: missing " + error.args[0]
+            )
+        except (TypeError, ValueError, AttributeError):
+            raise DataValidationError(
+                "Invalid order_header: body of request contained bad or no data"
+            )
+        header["total_amount"], header["item_count"], header["unit_count"] = Order.totals(rows)
+        Order.check_ranges(header, rows)
+        return header, rows
+
+    @staticmethod
+    def check_ranges(header, rows):
+        """ Raises a DataValidationError when a value of batch_row() does not fit its column """
+        integers = [header["customer_id"], header["item_count"], header["unit_count"]]
+        for row in rows:
+            integers += [row["product_id"], row["product_quantity"]]
+            if not row["product_price"].is_finite() or abs(row["product_price"]) > PRICE_MAX:
+                raise DataValidationError("Invalid product: product_price is out of range")
+        if any(not INTEGER_MIN <= value <= INTEGER_MAX for value in integers):
+            raise DataValidationError("Invalid order_header: a number is out of range")
+        if abs(header["total_amount"]) > TOTAL_MAX:
+            raise DataValidationError("Invalid order_header: total_amount is out of range")
+
+    @staticmethod
+    def totals(rows):
+        """ Returns the total_amount, item_count and unit_count of normalized item rows """
+        return (
+            sum((row["product_price"] * row["product_quantity"] for row in rows), Decimal(0)),
+            len(rows),
+            sum(row["product_quantity"] for row in rows),
+        )
+
+    @classmethod
+    def item_totals(cls):
+        """ Returns the column values that recompute the totals of an order_header from its items """
+        table = cls.__table__
+        items = OrderItem.__table__
+        of_order = items.c.order_id == table.c.id
         return {
-            "id": self.id,
-            "date_order": self.date_order,
-            "customer_id": self.customer_id,
-            "items": [item.serialize() for item in self.items],
-            "item_list": [item.serialize() for item in self.items]
+            "total_amount": select(
+                func.coalesce(func.sum(items.c.product_price * items.c.product_quantity), 0)
+            ).where(of_order).scalar_subquery(),
+            "item_count": select(func.count(items.c.id)).where(of_order).scalar_subquery(),
+            "unit_count": select(func.coalesce(func.sum(items.c.product_quantity), 0)).where(of_order).scalar_subquery(),
         }
 
+    @classmethod
+    def insert_headers(cls, headers):
+        """ Inserts order_header rows and returns their ids in order, does not commit """
+        table = cls.__table__
+        ids = cls.reserve_ids(len(headers))
+        if ids is None:
+            return [db.session.execute(table.insert().values(header)).inserted_primary_key[0] for header in headers]
+        insert_chunked(table, [dict(header, id=order_id) for header, order_id in zip(headers, ids)])
+        return ids
+
+    @classmethod
+    def reserve_ids(cls, count):
+        """ Takes count ids from the PostgreSQL id sequence, returns None on other databases """
+        if db.session.get_bind().dialect.name != "postgresql":
+            return None
+        return db.session.execute(
+            text("SELECT nextval(pg_get_serial_sequence('\"order\"', 'id')) FROM generate_series(1, :count)"),
+            {"count": count}
+        ).scalars().all()
+
+    @classmethod
+    def delete_where(cls, **filters):
+        """
+        Removes every order_header matching the search filters with one DELETE
+
+        The items go with them through ON DELETE CASCADE, none are loaded.
+        On PostgreSQL the DELETE returns what the orders added to the
+        rollups so they are taken out without a race against new orders.
+        Returns the number of orders removed.
+        """
+        logger.info("Deleting orders matching %s", filters)
+        table = cls.__table__
+        matching = table.c.id.in_(cls.search(**filters).with_entities(cls.id).scalar_subquery())
+        try:
+            if db.session.get_bind().dialect.name == "postgresql":
+                removed = db.session.execute(
+                    table.delete().where(matching).returning(table.c.id, *cls.CONTRIBUTION)
+                ).all()
+                cls.forget(row.id for row in removed)
+            else:
+                removed = db.session.execute(select(table.c.id, *cls.CONTRIBUTION).where(matching)).all()
+                cls.search(**filters).delete(synchronize_session="fetch")
+            cls.rollup(removed=removed)
+            OrderTombstone.bury([row.id for row in removed])
+            OrderEvent.record("deleted", [row.id for row in removed])
+            count = len(removed)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        if cls.cache is not None:
+            cls.cache.clear()
+        return count
+
+    def serialize(self, items=True, fields=None):
+        """
+        Serializes an order_header into a dictionary
+
+        Without items only the header and its item totals are returned and
+        the items are not loaded. fields limits the header to some of FIELDS.
+        """
+        data = {name: getattr(self, name) for name in (self.FIELDS if fields is None else fields)}
+        if items:
+            data["items"] = data["item_list"] = [item.serialize() for item in self.items]
+        return data
+
     def deserialize(self, data):
         """
         Deserializes an order_header from a dictionary
@@ -126,21 +493,211 @@ class Order(db.Model):
             )
         return self
 
+    @classmethod
+    def touch(cls, id):
+        """
+        Bumps the version of an order_header whose items changed and
+        recomputes its totals and its share of the rollups, does not commit
+        """
+        table = cls.__table__
+        db.session.flush()  # the totals must see pending item changes
+        removed = cls.contributions(table.c.id == id, lock=True)
+        db.session.execute(
+            table.update()
+            .where(table.c.id == id)
+            .values(version=table.c.version + 1, updated_at=datetime.utcnow(), **cls.item_totals())
+        )
+        cls.rollup(removed, cls.contributions(table.c.id == id))
+        OrderEvent.record("updated", [id])
+
+    @classmethod
+    def bump_version(cls, id, expected_version=None, items=0, units=0, amount=0):
+        """
+        Moves an order_header to its next version, compared and set in one
+        UPDATE that keeps the row locked until the end of the transaction
+
+        items, units and amount are added to the item_count, unit_count and
+        total_amount of the order in the same UPDATE, so a single item write
+        changes the header with one statement. Returns the new version and
+        updated_at with what the row added to the rollups before these
+        changes, does not commit. Raises VersionConflictError when the order
+        is not at expected_version and NotFound when it is gone and no
+        version was expected.
+        """
+        table = cls.__table__
+        condition = table.c.id == id
+        if expected_version is not None:
+            condition = and_(condition, table.c.version == expected_version)
+        values = {"version": table.c.version + 1, "updated_at": datetime.utcnow()}
+        if items or units or amount:
+            values.update(item_count=table.c.item_count + items, unit_count=table.c.unit_count + units,
+                          total_amount=table.c.total_amount + amount)
+        update = table.update().where(condition).values(values)
+        returned = (table.c.version, table.c.updated_at, *cls.CONTRIBUTION)
+        if db.session.get_bind().dialect.name == "postgresql":
+            row = db.session.execute(update.returning(*returned)).first()
+        elif db.session.execute(update).rowcount == 1:
+            row = db.session.execute(select(*returned).where(table.c.id == id)).one()
+        else:
+            row = None
+        if row is None:
+            if expected_version is None:
+                # without a precondition a deleted order is simply not found
+                raise NotFound(f"Order with id [{id}] no longer exists.")
+            raise VersionConflictError(f"Order with id [{id}] is no longer at version [{expected_version}].")
+        return SimpleNamespace(**dict(row._mapping, unit_count=row.unit_count - units,
+                                      total_amount=row.total_amount - amount))
+
+    @classmethod
+    def adjust(cls, id, stored, units, amount):
+        """
+        Moves the share of the rollups of an order_header whose totals
+        bump_version() changed by units and amount, does not commit
+        """
+        changed = dict(vars(stored), unit_count=stored.unit_count + units,
+                       total_amount=stored.total_amount + amount)
+        cls.rollup([stored], [SimpleNamespace(**changed)])
+        OrderEvent.record("updated", [id])
+
+    @classmethod
+    def contributions(cls, condition, lock=False):
+        """
+        Returns what the order_headers matching condition add to the rollups
+
+        With lock the rows stay locked until the end of the transaction so
+        nothing changes them between reading and writing their rollups
+        """
+        query = select(*cls.CONTRIBUTION).where(condition)
+        if lock:
+            query = query.with_for_update()
+        with db.session.no_autoflush:  # reads the stored row, not pending changes
+            return db.session.execute(query).all()
+
+    @classmethod
+    def rollup(cls, removed=(), added=()):
+        """
+        Applies the difference between two sets of contributions to the
+        customer and daily rollups, one upsert per rollup, does not commit
+        """
+        for model, key_of in ((CustomerStats, lambda row: row.customer_id),
+                              (DailyStats, lambda row: row.date_order.date())):
+            deltas = defaultdict(lambda: [0, 0, Decimal(0)])
+            for rows, sign in ((removed, -1), (added, 1)):
+                for row in rows:
+                    delta = deltas[key_of(row)]
+                    delta[0] += sign
+                    delta[1] += sign * row.unit_count
+                    delta[2] += sign * row.total_amount
+            model.apply({key: delta for key, delta in deltas.items() if any(delta)})
+
+    @classmethod
+    def rebuild_rollups(cls):
+        """
+        Recomputes the totals of every order_header from its items and the
+        rollups from the order_headers, in one transaction
+
+        Only the order_headers whose totals were wrong are written. They
+        move to their next version and get an "updated" event like any
+        other change. Returns the number of customers and days in the rollups
+        """
+        logger.info("Rebuilding the order totals and rollups")
+        table = cls.__table__
+        totals = cls.item_totals()
+        wrong = or_(*(table.c[name].is_distinct_from(total) for name, total in totals.items()))
+        fix = table.update().values(version=table.c.version + 1, updated_at=datetime.utcnow(), **totals)
+        try:
+            if db.session.get_bind().dialect.name == "postgresql":
+                ids = db.session.execute(fix.where(wrong).returning(table.c.id)).scalars().all()
+            else:
+                ids = db.session.execute(select(table.c.id).where(wrong)).scalars().all()
+                db.session.execute(fix.where(table.c.id.in_(ids)))
+            logger.info("Fixed the totals of %d orders", len(ids))
+            OrderEvent.record("updated", ids)
+            counts = []
+            for model, key in ((CustomerStats, table.c.customer_id), (DailyStats, func.date(table.c.date_order))):
+                db.session.execute(model.__table__.delete())
+                db.session.execute(model.__table__.insert().from_select(
+                    [model.KEY, "order_count", "units", "revenue"],
+                    select(key, func.count(), func.sum(table.c.unit_count), func.sum(table.c.total_amount))
+                    .group_by(key)
+                ))
+                counts.append(model.query.count())
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        for id in ids:
+            cls.invalidate(id)
+        return tuple(counts)
+
+    @classmethod
+    def forget(cls, ids):
+        """ Drops deleted order_headers from the session """
+        for id in ids:
+            order = db.session.identity_map.get(db.session.identity_key(cls, id))
+            if order is not None:
+                db.session.expunge(order)
+
+    @classmethod
+    def load_items(cls, orders):
+        """ Loads the items of a list of order_headers with a single SELECT """
+        items = {order.id: [] for order in orders}
+        if items:
+            query = OrderItem.query.filter(OrderItem.order_id.in_(list(items))).order_by(OrderItem.id)
+            for item in query:
+                items[item.order_id].append(item)
+        for order in orders:
+            set_committed_value(order, "items", items[order.id])
+        return orders
+
+    @classmethod
+    def invalidate(cls, id):
+        """ Drops an order_header from the read-through cache """
+        if cls.cache is not None and id is not None:
+            cls.cache.delete(int(id))
+
     @classmethod
     def init_db(cls, app):
         """ Initializes the database session """
         logger.info("Initializing database")
         cls.app = app
+        cls.cache = create_cache(app.config)
+        options = app.config.setdefault("SQLALCHEMY_ENGINE_OPTIONS", {})
+        for key, value in engine_options(app.config, app.config["SQLALCHEMY_DATABASE_URI"]).items():
+            options.setdefault(key, value)
         # This is where we initialize SQLAlchemy from the Flask app
         db.init_app(app)
         app.app_context().push()
         db.create_all()  # make our sqlalchemy tables
+        cls.init_replicas(app)
+
+    @classmethod
+    def init_replicas(cls, app):
+        """ Creates an engine for every database in REPLICA_DATABASE_URIS """
+        for engine in cls.replicas:
+            engine.dispose()
+        cls.replicas = [
+            create_engine(uri, **engine_options(app.config, uri))
+            for uri in app.config["REPLICA_DATABASE_URIS"]
+        ]
+        cls._replica_cycle = cycle(cls.replicas)
+        logger.info("Reading from %d replica(s)", len(cls.replicas))
+
+    @classmethod
+    def next_replica(cls):
+        """ Returns the next replica engine round-robin, or None without replicas """
+        return next(cls._replica_cycle, None)
+
+    @classmethod
+    def with_items(cls):
+        """ Returns a query that loads the items of every order in one extra SELECT """
+        return cls.query.options(selectinload(cls.items))
 
     @classmethod
     def all(cls):
         """ Returns all of the order_headers in the database """
         logger.info("Processing all order_header")
-        return cls.query.all()
+        return cls.with_items().all()
 
     @classmethod
     def find(cls, id):
@@ -148,23 +705,164 @@ class Order(db.Model):
         logger.info("Processing lookup for id %s ...", id)
         return cls.query.get(id)
 
+    @classmethod
+    def find_many(cls, ids):
+        """
+        Finds the order_headers with the given ids and loads their items
+
+        Runs one SELECT for the orders and one for their items whatever the
+        number of ids. Returns a dictionary of the orders found by id.
+        """
+        logger.info("Processing lookup for %d ids ...", len(ids))
+        orders = cls.query.filter(cls.id.in_(ids)).all() if ids else []
+        return {order.id: order for order in cls.load_items(orders)}
+
     @classmethod
     def find_or_404(cls, id):
         """ Find an order_header by its id """
         logger.info("Processing lookup or 404 for id %s ...", id)
-        return cls.query.get_or_404(id)
+        return cls.with_items().get_or_404(id)
+
+    @classmethod
+    def paginate(cls, query, limit, after=None, sort=None, descending=False):
+        """
+        Adds the keyset, the ordering and the limit of a page to a query or
+        a select, limit + 1 rows are fetched to tell if more rows follow
+        """
+        columns = [cls.id] if sort is None else [getattr(cls, sort), cls.id]
+        if after is not None:
+            keyset, last = tuple_(*columns), tuple_(*after)
+            query = query.filter(keyset < last if descending else keyset > last)
+        ordering = [column.desc() for column in columns] if descending else columns
+        return query.order_by(*ordering).limit(limit + 1)
+
+    @classmethod
+    def selected_columns(cls, sort=None, fields=None):
+        """
+        Returns the columns to SELECT for some FIELDS, with the keyset and
+        the version a page needs, every column of FIELDS when fields is None
+        """
+        names = ["id", sort, "version", "updated_at", *(cls.FIELDS if fields is None else fields)]
+        return [getattr(cls, name) for name in dict.fromkeys(names) if name is not None]
+
+    @staticmethod
+    def sort_key(order, sort=None):
+        """ Returns the keyset values of an order for paginate() """
+        return [order.id] if sort is None else [getattr(order, sort), order.id]
+
+    @classmethod
+    def last_modified(cls):
+        """
+        Returns when an Order was last written or deleted, None when there never was one
+
+        The tombstones of the deleted Orders count, so a deletion moves the
+        time forward even though no remaining Order changed.
+        """
+        latest = union_all(
+            select(func.max(cls.updated_at).label("at")),
+            select(func.max(OrderTombstone.deleted_at).label("at")),
+        ).subquery()
+        return db.session.execute(select(func.max(latest.c.at))).scalar()
+
+    @classmethod
+    def changes(cls, since, limit, after=None):
+        """
+        Returns one page of the orders written and deleted since a point in time
+
+        Orders and tombstones are merged in (updated_at, id) order, each side
+        read through its own (time, id) index and cut at limit + 1 rows.
+
+        Args:
+            since (datetime): the first modification time to return, included
+            limit (int): the maximum number of changes to return
+            after: the (updated_at, id) key of the last change of the previous page
+
+        Returns a list of (updated_at, id, order) where order is None for a
+        deleted order, and whether more changes follow
+        """
+        arms = []
+        for id, updated_at, deleted in ((cls.id, cls.updated_at, false()),
+                                        (OrderTombstone.order_id, OrderTombstone.deleted_at, true())):
+            arm = select(id.label("id"), updated_at.label("updated_at"), deleted.label("deleted")).where(updated_at >= since)
+            if after is not None:
+                arm = arm.where(tuple_(updated_at, id) > tuple_(*after))
+            arms.append(arm.order_by(updated_at, id).limit(limit + 1))
+        merged = union_all(*[arm.subquery().select() for arm in arms]).subquery()
+        rows = db.session.execute(
+            select(merged).order_by(merged.c.updated_at, merged.c.id).limit(limit + 1)
+        ).all()
+        more = len(rows) > limit
+        rows = rows[:limit]
+        live = cls.find_many([row.id for row in rows if not row.deleted])
+        # an order deleted between the two reads is reported as deleted
+        return [(row.updated_at, row.id, live.get(row.id)) for row in rows], more
+
+    @classmethod
+    def search(cls, customer_id=None, date_order=None, date_from=None, date_to=None,
+               product_id=None, min_total=None, max_total=None, min_items=None, max_items=None):
+        """
+        Returns the order_headers matching every filter that is given
+
+        Args:
+            customer_id (int): only orders of this customer
+            date_order: only orders placed on this day
+            date_from: only orders placed on or after this day
+            date_to: only orders placed on or before this day
+            product_id (int): only orders with an item for this product
+            min_total (Decimal): only orders whose items add up to at least this
+            max_total (Decimal): only orders whose items add up to at most this
+            min_items (int): only orders with at least this many items
+            max_items (int): only orders with at most this many items
+        """
+        return cls.query.filter(*cls.conditions(
+            customer_id, date_order, date_from, date_to, product_id, min_total, max_total, min_items, max_items
+        ))
+
+    @classmethod
+    def conditions(cls, customer_id=None, date_order=None, date_from=None, date_to=None,
+                   product_id=None, min_total=None, max_total=None, min_items=None, max_items=None):
+        """ Returns the WHERE clauses of the filters of search() for ORM and Core queries alike """
+        conditions = []
+        if customer_id is not None:
+            conditions.append(cls.customer_id == customer_id)
+        if date_order is not None:
+            date_from = date_to = date_order
+        if date_from is not None:
+            conditions.append(cls.date_order >= datetime.combine(parse_date(date_from), time.min))
+        if date_to is not None:
+            end = datetime.combine(parse_date(date_to), time.min) + timedelta(days=1)
+            conditions.append(cls.date_order < end)
+        if product_id is not None:
+            conditions.append(
+                select(OrderItem.id)
+                .where(OrderItem.order_id == cls.id, OrderItem.product_id == product_id)
+                .exists()
+            )
+        if min_total is not None:
+            conditions.append(cls.total_amount >= min_total)
+        if max_total is not None:
+            conditions.append(cls.total_amount <= max_total)
+        if min_items is not None:
+            conditions.append(cls.item_count >= min_items)
+        if max_items is not None:
+            conditions.append(cls.item_count <= max_items)
+        return conditions
 
     @classmethod
     def find_by_customer(cls, customer_id):
         """ Returns all order_header with the given customer id """
         # logger.info(f"Processing name query for {customer_id} ...",)
-        return cls.query.filter(cls.customer_id == customer_id)
+        return cls.search(customer_id=customer_id).options(selectinload(cls.items))
 
     @classmethod
     def find_by_date_order(cls, date_order):
         """ Returns all order_header with the given date order """
         # logger.info(f"Processing name query for {date_order} ...")
-        return cls.query.filter(func.date(cls.date_order) == date_order)
+        return cls.search(date_order=date_order).options(selectinload(cls.items))
+
+
+# Columns of an order_header that feed the rollups
+Order.CONTRIBUTION = tuple(Order.__table__.c[name] for name in ("customer_id", "date_order", "unit_count", "total_amount"))
 
 
 class OrderItem(db.Model):
@@ -180,9 +878,18 @@ class OrderItem(db.Model):
     product_price = db.Column(db.DECIMAL(10, 2), default=0)
     product_quantity = db.Column(db.Integer, nullable=False)
 
+    # Items are always loaded per order, in id order, and orders are searched by product
+    __table_args__ = (
+        db.Index("ix_order_item_order_id_id", "order_id", "id"),
+        db.Index("ix_order_item_product_id_order_id", "product_id", "order_id"),
+    )
+
     # Relationship
     order = db.relationship("Order", back_populates="items")
 
+    # The columns a client writes
+    VALUES = ("product_id", "product_price", "product_quantity")
+
     def __repr__(self):
         return f"<id=[{self.id}]>"
 
@@ -190,7 +897,24 @@ class OrderItem(db.Model):
         logger.info("Creating %s", self.id)
         self.id = None  # id must be none to generate next primary key
         db.session.add(self)
+        db.session.flush()
+        Order.touch(self.order_id)
         db.session.commit()
+        Order.invalidate(self.order_id)
+
+    @classmethod
+    def bulk_insert(cls, order_id, rows):
+        """
+        Inserts item rows for an order with multi-row INSERT statements
+
+        Does not commit, the caller owns the transaction
+        """
+        cls.insert_rows([dict(row, order_id=order_id) for row in rows])
+
+    @classmethod
+    def insert_rows(cls, rows):
+        """ Inserts item rows that carry their order_id, does not commit """
+        insert_chunked(cls.__table__, rows)
 
     def update(self):
         """
@@ -199,13 +923,216 @@ class OrderItem(db.Model):
         logger.info("Saving %s", self.id)
         if not self.id:
             raise DataValidationError("Update called with empty ID field")
+        Order.touch(self.order_id)
         db.session.commit()
+        Order.invalidate(self.order_id)
+
+    @classmethod
+    def add(cls, order_id, data, expected_version=None):
+        """
+        Adds one item to an order with a single INSERT
+
+        Returns the new item as a dictionary and the new version of the
+        order, raises VersionConflictError when the order is not at
+        expected_version
+        """
+        values = cls.normalize(cls.extract(data))
+        logger.info("Adding product %s to order %s", values["product_id"], order_id)
+        units, amount = values["product_quantity"], values["product_price"] * values["product_quantity"]
+        try:
+            stored = Order.bump_version(order_id, expected_version, 1, units, amount)
+            item_id = db.session.execute(
+                cls.__table__.insert().values(order_id=order_id, **values)
+            ).inserted_primary_key[0]
+            Order.adjust(order_id, stored, units, amount)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        Order.invalidate(order_id)
+        return dict(values, id=item_id, order_id=order_id), stored.version
+
+    @classmethod
+    def change(cls, order_id, item_id, data, expected_version=None):
+        """
+        Changes some of the values of one item of an order with a single UPDATE
+
+        Returns the item as a dictionary and the new version of the order,
+        or None when the order has no such item
+        """
+        try:
+            old = cls.find_row(order_id, item_id, lock=True)
+            if old is None:
+                return cls.missing(order_id, expected_version)
+            values = cls.normalize(dict(old._mapping, **{
+                key: value for key, value in (data or {}).items() if key in cls.VALUES
+            }))
+            units = values["product_quantity"] - old.product_quantity
+            amount = values["product_price"] * values["product_quantity"] - old.product_price * old.product_quantity
+            stored = Order.bump_version(order_id, expected_version, 0, units, amount)
+            logger.info("Changing item %s of order %s", item_id, order_id)
+            db.session.execute(cls.__table__.update().where(cls.id == item_id).values(values))
+            Order.adjust(order_id, stored, units, amount)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        Order.invalidate(order_id)
+        return dict(values, id=item_id, order_id=order_id), stored.version
+
+    @classmethod
+    def remove(cls, order_id, item_id, expected_version=None):
+        """
+        Removes one item of an order with a single DELETE
+
+        Returns the new version of the order or None when the order has no
+        such item
+        """
+        try:
+            old = cls.find_row(order_id, item_id, lock=True)
+            if old is None:
+                return cls.missing(order_id, expected_version)
+            units, amount = -old.product_quantity, -old.product_price * old.product_quantity
+            stored = Order.bump_version(order_id, expected_version, -1, units, amount)
+            logger.info("Removing item %s of order %s", item_id, order_id)
+            db.session.execute(cls.__table__.delete().where(cls.id == item_id))
+            Order.adjust(order_id, stored, units, amount)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        Order.invalidate(order_id)
+        return stored.version
+
+    @classmethod
+    def page(cls, order_id, limit, after=None, product_ids=None, min_price=None, max_price=None):
+        """
+        Returns one page of the items of an order in id order
+
+        Args:
+            order_id (int): the order that owns the items
+            limit (int): the maximum number of items to return
+            after (int): the id of the last item of the previous page
+            product_ids (list): only return the items of these products
+            min_price, max_price: only return the items priced within these bounds
+
+        Returns the items of the page and whether more items follow
+        """
+        query = cls.query.filter(cls.order_id == order_id)
+        if product_ids:
+            query = query.filter(cls.product_id.in_(product_ids))
+        if min_price is not None:
+            query = query.filter(cls.product_price >= min_price)
+        if max_price is not None:
+            query = query.filter(cls.product_price <= max_price)
+        if after is not None:
+            query = query.filter(cls.id > after)
+        items = query.order_by(cls.id).limit(limit + 1).all()
+        return items[:limit], len(items) > limit
+
+    @classmethod
+    def find_row(cls, order_id, item_id, lock=False):
+        """
+        Returns the stored values of an item of an order or None
+
+        With lock the order_header is locked until the end of the
+        transaction, before its items like every other write to the order
+        """
+        query = select(*(cls.__table__.c[key] for key in cls.VALUES)).where(cls.id == item_id, cls.order_id == order_id)
+        if lock:
+            query = query.join(Order.__table__, Order.id == cls.order_id).with_for_update(of=Order.__table__)
+        return db.session.execute(query).first()
+
+    @staticmethod
+    def missing(order_id, expected_version):
+        """
+        Answers a write to an item that find_row() did not find, raises
+        like bump_version() when the order itself is gone or changed and
+        returns None when only the item is missing
+        """
+        try:
+            Order.bump_version(order_id, expected_version)
+        finally:
+            db.session.rollback()
+        return None
+
+    @classmethod
+    def reconcile(cls, order_id, item_list):
+        """
+        Brings the stored items of an order in line with item_list
+
+        Incoming items are paired with stored rows by id when one is given,
+        otherwise by product_id. Unchanged pairs are left alone, changed
+        pairs are written with one UPDATE, leftover stored rows with one
+        DELETE and new items with multi-row INSERTs. Does not commit.
+
+        Args:
+            order_id (int): the order that owns the items
+            item_list (list): the item dictionaries sent by the client
+        """
+        table = cls.__table__
+        stored = db.session.execute(
+            select(cls.id, cls.product_id, cls.product_price, cls.product_quantity)
+            .where(cls.order_id == order_id)
+            .order_by(cls.id)
+        ).all()
+        unmatched = {row.id: row for row in stored}
+        incoming = [(item, cls.normalize(cls.extract(item))) for item in item_list]
+
+        pairs = []
+        pending = []
+        for item, values in incoming:
+            try:
+                row = unmatched.pop(int(item["id"]), None)
+            except (KeyError, TypeError, ValueError):
+                row = None
+            if row is None:
+                pending.append(values)
+            else:
+                pairs.append((row, values))
+        by_product = {}
+        for row in unmatched.values():
+            by_product.setdefault(row.product_id, []).append(row)
+        inserts = []
+        for values in pending:
+            candidates = by_product.get(values["product_id"])
+            if candidates:
+                row = candidates.pop(0)
+                del unmatched[row.id]
+                pairs.append((row, values))
+            else:
+                inserts.append(values)
+
+        updates = {
+            row.id: values for row, values in pairs
+            if (row.product_id, row.product_price, row.product_quantity)
+            != (values["product_id"], values["product_price"], values["product_quantity"])
+        }
+        if unmatched:
+            db.session.execute(table.delete().where(table.c.id.in_(list(unmatched))))
+        if updates:
+            db.session.execute(
+                table.update()
+                .where(table.c.id.in_(list(updates)))
+                .values({
+                    column: case(
+                        {item_id: values[column] for item_id, values in updates.items()},
+                        value=table.c.id
+                    )
+                    for column in ("product_id", "product_price", "product_quantity")
+                })
+            )
+        cls.bulk_insert(order_id, inserts)
+        return {"inserted": len(inserts), "updated": len(updates), "deleted": len(unmatched)}
 
     def delete(self):
         """ Removes an orderitem from the data store """
         logger.info("Deleting %s", self.id)
+        order_id = self.order_id
         db.session.delete(self)
+        Order.touch(order_id)
         db.session.commit()
+        Order.invalidate(order_id)
 
     def serialize(self):
         """ Serializes a product into a dictionary """
@@ -224,12 +1151,50 @@ class OrderItem(db.Model):
         Args:
             data (dict): A dictionary containing the resource data
         """
+        values = self.extract(data)
         try:
             self.order_id = data["order_id"]
-            self.product_id = data["product_id"]
-            self.product_price = data["product_price"]
-            self.product_quantity = data["product_quantity"]
+        except KeyError as error:
+            raise DataValidationError(
+                "Invalid product: missing " + error.args[0]
+            )
+        for key, value in values.items():
+            setattr(self, key, value)
+        return self
+
+    @staticmethod
+    def normalize(values):
+        """
+        Coerces extracted item values to the types stored in the database
+
+        Args:
+            values (dict): the column values returned by extract()
+        """
+        try:
+            return {
+                "product_id": int(values["product_id"]),
+                "product_price": Decimal(str(values["product_price"])).quantize(PRICE_QUANTUM),
+                "product_quantity": int(values["product_quantity"]),
+            }
+        except (TypeError, ValueError, InvalidOperation):
+            raise DataValidationError(
+                "Invalid product: product_id, product_price and product_quantity must be numbers"
+            )
+
+    @staticmethod
+    def extract(data):
+        """
+        Validates an item dictionary and returns its column values
 
+        Args:
+            data (dict): A dictionary containing the item data
+        """
+        try:
+            return {
+                "product_id": data["product_id"],
+                "product_price": data["product_price"],
+                "product_quantity": data["product_quantity"],
+            }
         except KeyError as error:
             raise DataValidationError(
                 "Invalid product: missing " + error.args[0]
@@ -238,4 +1203,311 @@ class OrderItem(db.Model):
             raise DataValidationError(
                 "Invalid product: body of request contained bad or no data"
             )
-        return self
+
+
+class RetentionMixin:
+    """ Rows that are only kept for a while, AGE names the column holding when each was written """
+
+    @classmethod
+    def purge(cls, before):
+        """ Removes the rows older than a point in time, returns how many """
+        logger.info("Purging the %s rows older than %s", cls.__tablename__, before)
+        try:
+            count = cls.query.filter(getattr(cls, cls.AGE) < before).delete(synchronize_session=False)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        return count
+
+
+class OrderTombstone(RetentionMixin, db.Model):
+    """
+    Class that records the deletion of an order for the delta feed
+
+    Tombstones are kept for TOMBSTONE_RETENTION_DAYS, a mirror that last
+    synced before that has to read the whole order list again.
+    """
+    __tablename__ = "order_tombstone"
+    AGE = "deleted_at"
+
+    order_id = db.Column(db.Integer, primary_key=True)
+    deleted_at = db.Column(db.DateTime(), nullable=False, default=datetime.utcnow)
+
+    __table_args__ = (db.Index("ix_order_tombstone_deleted_at_order_id", "deleted_at", "order_id"),)
+
+    def __repr__(self):
+        return f"<OrderTombstone order_id=[{self.order_id}]>"
+
+    @classmethod
+    def bury(cls, order_ids):
+        """ Records the deletion of orders with multi-row INSERTs, does not commit """
+        deleted_at = datetime.utcnow()
+        insert_chunked(cls.__table__, [{"order_id": order_id, "deleted_at": deleted_at} for order_id in order_ids])
+
+
+class OrderEvent(RetentionMixin, db.Model):
+    """
+    Class that represents a change to an order, written to the outbox in
+    the transaction of the change
+
+    On PostgreSQL every event carries the id of the transaction that wrote
+    it. Events are read in (txid, id) order and only once no transaction
+    that started before theirs is still running, so a consumer that follows
+    the outbox never skips an event that commits late. A transaction left
+    open for a long time holds back every event written after it started.
+    """
+    __tablename__ = "order_event"
+    AGE = "created_at"
+
+    id = db.Column(db.BigInteger().with_variant(db.Integer, "sqlite"), primary_key=True)
+    txid = db.Column(db.BigInteger, nullable=False, default=0)
+    order_id = db.Column(db.Integer, nullable=False)
+    type = db.Column(db.String(16), nullable=False)
+    created_at = db.Column(db.DateTime(), nullable=False, default=datetime.utcnow)
+
+    __table_args__ = (db.Index("ix_order_event_txid_id", "txid", "id"),)
+
+    def __repr__(self):
+        return f"<OrderEvent id=[{self.id}] {self.type} order_id=[{self.order_id}]>"
+
+    def serialize(self):
+        """ Serializes an event into a dictionary """
+        return {
+            "id": self.id,
+            "order_id": self.order_id,
+            "type": self.type,
+            "created_at": self.created_at,
+        }
+
+    @staticmethod
+    def postgresql():
+        """ Tells if the outbox lives in PostgreSQL and can be ordered by transaction """
+        return db.session.get_bind().dialect.name == "postgresql"
+
+    @classmethod
+    def record(cls, kind, order_ids):
+        """ Writes one event of a kind per order with multi-row INSERTs, does not commit """
+        txid = func.txid_current() if cls.postgresql() else 0
+        created_at = datetime.utcnow()
+        rows = [{"txid": txid, "order_id": order_id, "type": kind, "created_at": created_at}
+                for order_id in order_ids]
+        insert_chunked(cls.__table__, rows)
+
+    @classmethod
+    def position(cls, event_id):
+        """
+        Returns the (txid, id) outbox position of an event, the start of the
+        outbox for 0 and None when the event is unknown or purged
+        """
+        if not event_id:
+            return (-1, 0)
+        row = db.session.execute(select(cls.txid, cls.id).where(cls.id == event_id)).first()
+        return tuple(row) if row is not None else None
+
+    @classmethod
+    def after(cls, position, limit):
+        """ Returns up to limit events that follow an outbox position """
+        query = cls.query.filter(tuple_(cls.txid, cls.id) > tuple_(*position))
+        if cls.postgresql():
+            query = query.filter(cls.txid < func.txid_snapshot_xmin(func.txid_current_snapshot()))
+        return query.order_by(cls.txid, cls.id).limit(limit).all()
+
+    @classmethod
+    def head(cls):
+        """
+        Returns the outbox position of the last event after() can return,
+        the start of the outbox when there is none
+
+        The events after() starts to return always follow this position,
+        so it only moves forward.
+        """
+        query = select(cls.txid, cls.id)
+        if cls.postgresql():
+            query = query.where(cls.txid < func.txid_snapshot_xmin(func.txid_current_snapshot()))
+        row = db.session.execute(query.order_by(cls.txid.desc(), cls.id.desc()).limit(1)).first()
+        return tuple(row) if row is not None else (-1, 0)
+
+
+class RollupMixin:
+    """ Running totals of a group of orders, kept up to date by Order.rollup() """
+
+    order_count = db.Column(db.Integer, nullable=False, default=0)
+    units = db.Column(db.BigInteger, nullable=False, default=0)
+    revenue = db.Column(db.DECIMAL(14, 2), nullable=False, default=0)
+
+    @classmethod
+    def apply(cls, deltas):
+        """
+        Adds the (order_count, units, revenue) deltas keyed by the rollup key
+        with one INSERT ... ON CONFLICT DO UPDATE, does not commit
+
+        The rows are locked in key order so that two transactions touching
+        the same rollups cannot deadlock.
+        """
+        if not deltas:
+            return
+        table = cls.__table__
+        dialect = db.session.get_bind().dialect.name
+        insert = (sqlite.insert if dialect == "sqlite" else postgresql.insert)(table).values([
+            {cls.KEY: key, "order_count": count, "units": units, "revenue": revenue}
+            for key, (count, units, revenue) in sorted(deltas.items())
+        ])
+        db.session.execute(insert.on_conflict_do_update(
+            index_elements=[cls.KEY],
+            set_={name: table.c[name] + insert.excluded[name] for name in ("order_count", "units", "revenue")},
+        ))
+
+    def serialize(self):
+        """ Serializes a rollup into a dictionary """
+        return {
+            self.KEY: getattr(self, self.KEY),
+            "order_count": self.order_count,
+            "units": self.units,
+            "revenue": self.revenue,
+        }
+
+
+class CustomerStats(RollupMixin, db.Model):
+    """
+    Class that represents the order count, units and revenue of a customer
+    """
+    __tablename__ = "customer_stats"
+    KEY = "customer_id"
+
+    customer_id = db.Column(db.Integer, primary_key=True)
+
+    def __repr__(self):
+        return f"<CustomerStats customer_id=[{self.customer_id}]>"
+
+    @classmethod
+    def find(cls, customer_id):
+        """ Returns the rollup of a customer or None """
+        logger.info("Processing stats lookup for customer %s ...", customer_id)
+        return cls.query.get(customer_id)
+
+
+class DailyStats(RollupMixin, db.Model):
+    """
+    Class that represents the order count, units and revenue of a calendar day
+    """
+    __tablename__ = "daily_stats"
+    KEY = "day"
+
+    day = db.Column(db.Date, primary_key=True)
+
+    def __repr__(self):
+        return f"<DailyStats day=[{self.day}]>"
+
+    @classmethod
+    def between(cls, date_from=None, date_to=None):
+        """ Returns the rollups of the days from date_from to date_to, both included """
+        logger.info("Processing daily stats from %s to %s ...", date_from, date_to)
+        query = cls.query
+        if date_from is not None:
+            query = query.filter(cls.day >= parse_date(date_from))
+        if date_to is not None:
+            query = query.filter(cls.day <= parse_date(date_to))
+        return query.order_by(cls.day)
+
+
+class IdempotencyKey(db.Model):
+    """
+    Class that remembers the response to a POST /orders sent with an Idempotency-Key
+
+    The key is the primary key so a lookup is a single index probe, a
+    retried request is answered from the stored body without reading the
+    order tables. Keys are forgotten once they expire.
+    """
+    __tablename__ = "idempotency_key"
+
+    key = db.Column(db.String(IDEMPOTENCY_KEY_LENGTH), primary_key=True)
+    request_hash = db.Column(db.String(64), nullable=False)
+    order_id = db.Column(db.Integer, nullable=False)
+    response = db.Column(db.Text, nullable=False)
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)
+
+    # monotonic time of the next sweep of the expired keys
+    next_purge = 0.0
+
+    # lookup cost, reported by /metrics
+    _stats_lock = threading.Lock()
+    lookups = 0
+    replays = 0
+    lookup_seconds = 0.0
+    max_lookup_seconds = 0.0
+
+    def __repr__(self):
+        return f"<IdempotencyKey {self.key} order_id=[{self.order_id}]>"
+
+    @staticmethod
+    def hash_request(data):
+        """ Returns a digest of a request body that ignores key order and spacing """
+        canonical = json.dumps(data, sort_keys=True, separators=(",", ":"), default=str)
+        return sha256(canonical.encode("utf-8")).hexdigest()
+
+    def remember(self, order):
+        """
+        Stores the response to the order being created
+
+        Runs inside the transaction of Order.create() and, at most once every
+        PURGE_INTERVAL seconds, removes the keys that have expired. An expired
+        row left under this key is always removed so the key can be reused
+        before the next sweep. Does not commit
+        """
+        self.order_id = order.id
+        # one round trip reloads the values as the database normalized them,
+        # the body is kept so the first request is answered without more queries
+        Order.query.options(joinedload(Order.items)).populate_existing().filter(Order.id == order.id).one()
+        self.body = order.serialize()
+        self.response = json.dumps(self.body, default=json_default)
+        expired = IdempotencyKey.expires_at < datetime.utcnow()
+        if timer.monotonic() >= IdempotencyKey.next_purge:
+            IdempotencyKey.next_purge = timer.monotonic() + PURGE_INTERVAL
+        else:
+            expired = and_(expired, IdempotencyKey.key == self.key)
+        IdempotencyKey.query.filter(expired).delete(synchronize_session=False)
+        db.session.add(self)
+
+    def replay(self):
+        """ Returns the stored response body """
+        with IdempotencyKey._stats_lock:
+            IdempotencyKey.replays += 1
+        return json.loads(self.response)
+
+    @classmethod
+    def lookup(cls, key):
+        """
+        Returns the unexpired IdempotencyKey stored under key or None
+
+        Runs the prebuilt LOOKUP_STATEMENT, building and caching a new
+        statement each time costs several times the primary key probe
+        """
+        connection = db.session.connection()  # the pool checkout is measured by the pool
+        start = timer.perf_counter()
+        row = connection.execute(LOOKUP_STATEMENT, {"key": key, "now": datetime.utcnow()}).first()
+        elapsed = timer.perf_counter() - start
+        with cls._stats_lock:
+            cls.lookups += 1
+            cls.lookup_seconds += elapsed
+            cls.max_lookup_seconds = max(cls.max_lookup_seconds, elapsed)
+        logger.debug("Idempotency key lookup took %.3f ms", elapsed * 1000)
+        # a transient copy, the key is only read
+        return cls(key=key, **row._mapping) if row is not None else None
+
+    @classmethod
+    def stats(cls):
+        """ Returns the lookup and replay counters """
+        with cls._stats_lock:
+            return {
+                "lookups": cls.lookups,
+                "replays": cls.replays,
+                "lookup_seconds": round(cls.lookup_seconds, 6),
+                "max_lookup_seconds": round(cls.max_lookup_seconds, 6),
+            }
+
+
+LOOKUP_STATEMENT = (
+    select(IdempotencyKey.request_hash, IdempotencyKey.order_id, IdempotencyKey.response)
+    .where(IdempotencyKey.key == bindparam("key"), IdempotencyKey.expires_at >= bindparam("now"))
+)
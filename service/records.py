@@ -0,0 +1,92 @@
+"""
+Order Records
+
+Read model of the Orders behind the list, search and export endpoints
+
+Rows are selected with SQLAlchemy Core and kept in __slots__ records, so
+the rows that are only read and serialized never become ORM instances:
+there is no identity map entry, no instance state and no relationship
+instrumentation to build and garbage collect for them. The records have
+the attributes of the models so the compiled serializers read both.
+Writes keep going through the ORM models.
+"""
+from sqlalchemy import select
+
+from service.models import db, Order, OrderItem
+
+
+class OrderRecord:
+    """ Read-only order_header row, items is set by load_items() """
+
+    __slots__ = ("id", "date_order", "customer_id", "version", "updated_at",
+                 "total_amount", "item_count", "unit_count", "items")
+
+    def __init__(self, names, values):
+        for name, value in zip(names, values):
+            setattr(self, name, value)
+
+    def __repr__(self):
+        return f"<OrderRecord id=[{self.id}]>"
+
+
+class ItemRecord:
+    """ Read-only order_item row """
+
+    __slots__ = ("id", "order_id", "product_id", "product_price", "product_quantity")
+
+    def __init__(self, id, order_id, product_id, product_price, product_quantity):
+        self.id = id
+        self.order_id = order_id
+        self.product_id = product_id
+        self.product_price = product_price
+        self.product_quantity = product_quantity
+
+    def __repr__(self):
+        return f"<ItemRecord id=[{self.id}]>"
+
+
+ITEM_COLUMNS = tuple(OrderItem.__table__.c[name] for name in ItemRecord.__slots__)
+
+
+def table_columns(attributes):
+    """ Returns the Core columns of ORM attributes, a select of Core columns skips the ORM result handling """
+    return [attribute.property.columns[0] for attribute in attributes]
+
+
+def page(filters, limit, after=None, sort=None, descending=False, fields=None):
+    """
+    Returns one page of the Orders matching the filters of Order.search()
+
+    Takes the paging arguments of Order.paginate() and returns the
+    records of the page and whether more Orders follow
+    """
+    columns = table_columns(Order.selected_columns(sort, fields))
+    query = Order.paginate(select(*columns).where(*Order.conditions(**filters)), limit, after, sort, descending)
+    names = [column.key for column in columns]
+    records = [OrderRecord(names, row) for row in db.session.execute(query).all()]
+    return records[:limit], len(records) > limit
+
+
+def stream(batch_size):
+    """
+    Yields a record of every Order with its items, fetched batch_size
+    Orders at a time through a server-side cursor
+    """
+    columns = table_columns(Order.selected_columns())
+    names = [column.key for column in columns]
+    query = select(*columns).order_by(Order.id).execution_options(stream_results=True)
+    for rows in db.session.execute(query).partitions(batch_size):
+        yield from load_items([OrderRecord(names, row) for row in rows])
+
+
+def load_items(records):
+    """ Sets the items of order records with a single SELECT """
+    items = {record.id: [] for record in records}
+    if items:
+        query = select(*ITEM_COLUMNS).where(OrderItem.order_id.in_(list(items))).order_by(OrderItem.id)
+        for row in db.session.execute(query).all():
+            item = ItemRecord(*row)
+            items[item.order_id].append(item)
+    for record in records:
+        record.items = items[record.id]
+    return records
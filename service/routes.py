@@ -8,29 +8,78 @@ Describe what your service does here
 Order Store Service
 Paths:
 ------
-GET /orders - Returns a list all of the Orders
+GET /orders - Returns a page of the Orders, the next page is linked in the Link header
+GET /orders?fields={names}&expand=items - Returns a page of the Orders with only the fields asked for
+GET /orders?updated_since={ts} - Returns a page of the Orders changed or deleted since a time
+GET /orders/export - Streams all of the Orders as newline delimited JSON
 GET /orders/{id} - Returns the Order with a given id number
 POST /orders - creates a new Order record in the database
+POST /orders/batch - creates many Order records in the database
+POST /orders/lookup - Returns the Orders with the posted ids
 PUT /orders/{id} - updates a Order record in the database
+GET /orders/{id}?expand=none - Returns an Order with its item totals but not its items
+GET /orders/{id}/items - Returns a page of the items of an Order, the next page is linked in the Link header
+POST /orders/{id}/items - adds an item to an Order
+PATCH /orders/{id}/items/{item_id} - changes some values of an item of an Order
+DELETE /orders/{id}/items/{item_id} - removes an item from an Order
 DELETE /orders/{id} - deletes a Order record in the database
+DELETE /orders - deletes the Orders matching the filters in the query string
+GET /events?after={id} - Returns the Order change events that follow an event, waiting for them if asked
+GET /events/stream - Streams the Order change events as Server-Sent Events
+GET /stats/customers/{customer_id} - Returns the order count, units and revenue of a customer
+GET /stats/daily - Returns the order count, units and revenue of each day in a date range
 """
 
+import base64
+import hashlib
+import json
+import math
+from datetime import datetime, timedelta, timezone
+from decimal import Decimal
 import secrets
+import time
 from asyncio.log import logger
+from functools import lru_cache, wraps
 import logging
 from attr import validate
-from flask import jsonify, request, url_for, make_response, abort
-from flask_restx import Api, Resource, fields, reqparse, inputs
-from werkzeug.exceptions import NotFound
+from flask import jsonify, request, url_for, make_response, abort, Response, stream_with_context
+from flask_restx import Api, Resource, fields, reqparse, inputs, marshal, mask
+from sqlalchemy.exc import IntegrityError
+from werkzeug.exceptions import NotFound, ServiceUnavailable
+from werkzeug.http import http_date, parse_date, quote_etag, unquote_etag
+from urllib.parse import urlencode
 
 
-from service.models import Order
+from service.models import (
+    db, Order, OrderItem, OrderEvent, CustomerStats, DailyStats, IdempotencyKey, DataValidationError,
+    VersionConflictError, INTEGER_MIN, INTEGER_MAX, IDEMPOTENCY_KEY_LENGTH, parse_datetime
+)
+from service import records
+from service.events import EventWaiters
+from service.pool import pool_stats
+from service.serializers import compile_model, dumps
 from . import status  # HTTP Status Codes
 
 # Import Flask application
 from . import app
 
 
+JSON_MEDIA_TYPE = "application/json"
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+EVENT_STREAM_MEDIA_TYPE = "text/event-stream"
+
+# Longest silence on a Server-Sent Events stream, a comment line keeps proxies from closing it
+EVENT_KEEP_ALIVE_SECONDS = 15
+
+# The requests of this process that wait for change events
+event_waiters = EventWaiters()
+IF_MATCH_PARAM = {'If-Match': {'in': 'header', 'type': 'string',
+                               'description': 'Only write if the Order still has this ETag'}}
+
+# Documents the fields mask of the responses that are not marshalled by @api.marshal_with
+X_FIELDS_PARAM = {'X-Fields': {'in': 'header', 'type': 'string', 'format': 'mask',
+                               'description': 'An optional fields mask'}}
+
 # Document the type of autorization required
 authorizations = {
     'apikey': {
@@ -81,6 +130,12 @@ item_model = api.inherit(
     }
 )
 
+patch_item_model = api.model('ItemPatch', {
+    'product_id': fields.Integer(required=False),
+    'product_price': fields.Float(required=False),
+    'product_quantity': fields.Integer(required=False),
+})
+
 
 # Define the model so that the docs reflect what can be sent
 create_model = api.model('Order', {
@@ -97,15 +152,100 @@ order_model = api.inherit(
     {
         'id': fields.String(readOnly=True,
                             description='The unique id assigned internally by service'),
+        'total_amount': fields.Float(readOnly=True,
+                                     description='The sum of price times quantity over the items'),
+        'item_count': fields.Integer(readOnly=True,
+                                     description='The number of items in the order'),
+        'unit_count': fields.Integer(readOnly=True,
+                                     description='The sum of the quantities of the items'),
+        'updated_at': fields.DateTime(readOnly=True,
+                                      description='When the order or one of its items last changed'),
     }
 )
 
+order_summary_model = api.model(
+    'OrderSummary',
+    {name: field for name, field in order_model.resolved.items() if name != 'item_list'}
+)
+
+
+tombstone_model = api.model('OrderTombstone', {
+    'id': fields.String(description='The id of the deleted Order'),
+    'updated_at': fields.DateTime(description='When the Order was deleted'),
+    'deleted': fields.Boolean(description='Always true'),
+})
 
 
 # query string arguments
+SEARCH_FILTERS = ('customer_id', 'date_order', 'date_from', 'date_to', 'product_id',
+                  'min_total', 'max_total', 'min_items', 'max_items')
+SORT_CHOICES = [prefix + column for column in Order.SORT_COLUMNS for prefix in ('', '-')]
 order_args = reqparse.RequestParser()
-order_args.add_argument('customer_id', type=str, required=False, help='List Order by customer id')
+order_args.add_argument('customer_id', type=int, required=False, help='List Order by customer id')
 order_args.add_argument('date_order', type=str, required=False, help='The date when the order was placed')
+order_args.add_argument('date_from', type=str, required=False, help='List Order placed on or after this date')
+order_args.add_argument('date_to', type=str, required=False, help='List Order placed on or before this date')
+order_args.add_argument('product_id', type=int, required=False, help='List Order containing this product')
+order_args.add_argument('min_total', type=float, required=False, help='List Order worth at least this amount')
+order_args.add_argument('max_total', type=float, required=False, help='List Order worth at most this amount')
+order_args.add_argument('min_items', type=int, required=False, help='List Order with at least this many items')
+order_args.add_argument('max_items', type=int, required=False, help='List Order with at most this many items')
+order_args.add_argument('sort', type=str, required=False, choices=SORT_CHOICES,
+                        help='Sort the Orders by this column, prefix it with - to sort from the highest value')
+order_args.add_argument('updated_since', type=str, required=False,
+                        help='List the Orders changed or deleted at or after this ISO 8601 time, oldest first')
+order_args.add_argument('fields', type=str, required=False,
+                        help='Comma separated fields of the Orders to return, e.g. id,customer_id,date_order')
+order_args.add_argument('expand', type=str, required=False, choices=['items', 'none'],
+                        help='items adds the items to the fields, none leaves them out of the full Orders')
+order_args.add_argument('limit', type=inputs.int_range(1, app.config['MAX_PAGE_SIZE']), required=False,
+                        help='The maximum number of Orders to return')
+order_args.add_argument('next', type=str, required=False, help='The cursor of the page to return')
+
+event_model = api.model('OrderEvent', {
+    'id': fields.Integer(description='The position of the event in the outbox'),
+    'order_id': fields.String(description='The id of the Order that changed'),
+    'type': fields.String(enum=['created', 'updated', 'deleted'], description='What happened to the Order'),
+    'created_at': fields.DateTime(description='When the change was written'),
+})
+
+# query string arguments of the event feed
+event_args = reqparse.RequestParser()
+event_args.add_argument('after', type=inputs.natural, required=False, default=0,
+                        help='Return the events that follow the event with this id, 0 for the oldest')
+event_args.add_argument('limit', type=inputs.int_range(1, app.config['MAX_PAGE_SIZE']), required=False,
+                        help='The maximum number of events to return')
+event_args.add_argument('wait', type=float, required=False, default=0,
+                        help='Seconds to wait for an event when there is none yet')
+
+# query string arguments of a single Order
+order_get_args = reqparse.RequestParser()
+order_get_args.add_argument('expand', type=str, location='args', required=False, default='items',
+                            choices=['items', 'none'],
+                            help='none returns the Order with its item totals but without its items')
+
+# query string arguments of the item list
+item_args = reqparse.RequestParser()
+item_args.add_argument('product_id', type=int, action='append', required=False,
+                       help='List the items of this product, repeat it for several products')
+item_args.add_argument('min_price', type=float, required=False, help='List the items priced at least this much')
+item_args.add_argument('max_price', type=float, required=False, help='List the items priced at most this much')
+item_args.add_argument('limit', type=inputs.int_range(1, app.config['MAX_PAGE_SIZE']), required=False,
+                       help='The maximum number of items to return')
+item_args.add_argument('next', type=str, required=False, help='The cursor of the page to return')
+
+# query string arguments of a bulk delete
+delete_args = order_args.copy()
+delete_args.remove_argument('limit')
+delete_args.remove_argument('next')
+delete_args.remove_argument('sort')
+delete_args.remove_argument('updated_since')
+delete_args.remove_argument('fields')
+delete_args.remove_argument('expand')
+delete_args.add_argument('all', type=inputs.boolean, required=False, default=False,
+                         help='Delete every Order when no other filter is given')
+for argument in delete_args.args:
+    argument.location = 'args'  # a JSON Content-Type without a body must not fail the DELETE
 
 ######################################################################
 # Authorization Decorator
@@ -123,6 +263,48 @@ order_args.add_argument('date_order', type=str, required=False, help='The date w
 #             return {'message': 'Invalid or missing token'}, 401
 #     return decorated
 
+######################################################################
+# Replica Routing
+######################################################################
+READ_YOUR_WRITES_COOKIE = 'orders_last_write'
+
+
+def read_only(function):
+    """ Runs a read-only resource method against a replica """
+    @wraps(function)
+    def decorated(*args, **kwargs):
+        request.read_only = True
+        if not Order.replicas or wrote_recently():
+            return function(*args, **kwargs)
+        session = db.session()
+        session.replica = Order.next_replica()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            session.replica = None
+    return decorated
+
+
+def wrote_recently():
+    """ Tells if the client wrote within the read-your-writes window """
+    try:
+        last_write = float(request.cookies.get(READ_YOUR_WRITES_COOKIE, 0))
+    except ValueError:
+        return False
+    return last_write + app.config['READ_YOUR_WRITES_SECONDS'] > time.time()
+
+
+@app.after_request
+def remember_write(response):
+    """ Starts the read-your-writes window of a client after a successful write """
+    if (Order.replicas and request.method in ('POST', 'PUT', 'PATCH', 'DELETE')
+            and not getattr(request, 'read_only', False) and response.status_code < 400):
+        response.set_cookie(
+            READ_YOUR_WRITES_COOKIE, str(time.time()),
+            max_age=math.ceil(app.config['READ_YOUR_WRITES_SECONDS']), httponly=True
+        )
+    return response
+
 ######################################################################
 # Function to generate a random API key (good for testing)
 ######################################################################
@@ -142,6 +324,20 @@ def healthcheck():
 
 
 
+######################################################################
+# GET METRICS
+######################################################################
+@app.route("/metrics")
+def metrics():
+    """Returns the counters of the order cache, the connection pool, the idempotency keys and the event waiters"""
+    return make_response(
+        jsonify(order_cache=Order.cache.stats(), db_pool=pool_stats(db.engine.pool),
+                idempotency=IdempotencyKey.stats(), event_waiters=event_waiters.stats()),
+        status.HTTP_200_OK
+    )
+
+
+
 ######################################################################
 #  PATH: /orders/{id}
 ######################################################################
@@ -162,41 +358,73 @@ class OrderResource(Resource):
     # GET AN ORDER INFO
     ######################################################################
     # @app.route("/orders/<int:id>", methods=["GET"])
-    @api.doc('get_order')
+    @api.doc('get_order', params=X_FIELDS_PARAM)
+    @api.expect(order_get_args)
     @api.response(404, 'Order not found')
-    @api.marshal_with(order_model)
+    @api.response(304, 'The Order has not changed')
+    @api.response(200, 'Success', order_model)
+    @read_only
     def get(self, id):
         """
         Get info of an Order
         This endpoint will return an Order information based the id specified in the path
+        With expand=none the items are left out, their count and totals are still returned
         """
         app.logger.info("Request to get order info with id: %s", id)
-        order = Order.find_or_404(id)
+        args = order_get_args.parse_args()
+        key = order_key(id)
+        entry = Order.cache.get(key)
+        if entry is None:
+            order = check_valid_order(key)
+            headers = validator_headers(f"{order.id}.{order.version}", order.updated_at)
+            if is_not_modified(headers):
+                return Response(status=status.HTTP_304_NOT_MODIFIED, headers=headers)
+            if args['expand'] == 'none':
+                # the items are never loaded so there is nothing to cache
+                app.logger.info("Returning order %s without its items", key)
+                summary = marshal(order.serialize(items=False), order_summary_model)
+                return apply_mask(summary), status.HTTP_200_OK, headers
+            entry = {'headers': headers, 'order': marshal(order.serialize(), order_model)}
+            if db.session().replica is None:
+                # a lagging replica could put back an Order that a write just invalidated
+                Order.cache.set(key, entry)
+        elif is_not_modified(entry['headers']):
+            return Response(status=status.HTTP_304_NOT_MODIFIED, headers=entry['headers'])
 
-        app.logger.info("Returning order: %s", order.id)
-        return order.serialize(), status.HTTP_200_OK
+        app.logger.info("Returning order: %s", key)
+        order = entry['order']
+        if args['expand'] == 'none':
+            order = {name: value for name, value in order.items() if name != 'item_list'}
+        return apply_mask(order), status.HTTP_200_OK, entry['headers']
 
 
     ###################################################################### 
     #  UPDATE AN Order
     ######################################################################
-    @api.doc('update_orders')
+    @api.doc('update_orders', params=IF_MATCH_PARAM)
     @api.response(404, 'Order not found')
     @api.response(400, 'The posted Order data was not valid')
+    @api.response(412, 'The Order changed since the ETag in If-Match')
     @api.expect(order_model)    
     @api.marshal_with(order_model)
     # @app.route("/orders/<int:id>", methods=["PUT"])
     def put(self, id):
         """     
         Update an order  
+        With If-Match the update is only made if nobody changed the Order
+        since its ETag was read, e.g:
+        curl -X PUT -H 'If-Match: "1.3"' 'http://localhost:8000/orders/1'
         """
         app.logger.info("Request to update order with id: %s", id)
         order = check_valid_order(id)
+        expected_version = matched_version(order)
         order.deserialize(api.payload)
         order.id = id
-        order.update()
-        app.logger.info("Order with ID [%s] updated.", order.id)
-        return order.serialize(), status.HTTP_200_OK
+        changes = order.update(expected_version)
+        app.logger.info("Order with ID [%s] updated to version %s.", order.id, order.version)
+        headers = validator_headers(f"{order.id}.{order.version}", order.updated_at)
+        headers["X-Item-Changes"] = ", ".join(f"{kind}={count}" for kind, count in changes.items())
+        return order.serialize(), status.HTTP_200_OK, headers
 
 
     ######################################################################
@@ -235,35 +463,88 @@ class OrderCollection(Resource):
     # LIST ALL ORDERS
     ######################################################################
     # @app.route("/orders", methods=["GET"])
-    @api.doc('list_orders')
+    @api.doc('list_orders', params=X_FIELDS_PARAM)
     @api.expect(order_args, validate=True)
-    @api.marshal_list_with(order_model)
+    @api.response(200, 'Success', [order_model])
+    @api.response(304, 'The page has not changed')
+    @api.response(410, 'updated_since is older than the kept tombstones')
+    @read_only
     def get(self):
         """Returns all of the Orders"""
         app.logger.info("Request for order list")
         args = order_args.parse_args()
-        orders = []
-        
-        if args['customer_id'] is not None:
-            app.logger.info('Filtering by customer: %s', args['customer_id'])
-            orders = Order.find_by_customer(args['customer_id'])
-        elif args['date_order'] is not None:
-            app.logger.info('Filtering by order date: %s', args['date_order'])
-            orders = Order.find_by_date_order(args['date_order'])
+        if args['updated_since'] is not None:
+            return list_changes(args)
+        filters = search_filters(args)
+        if filters:
+            app.logger.info('Filtering by: %s', filters)
         else:
-            app.logger.info('Returning unfiltered list.')            
-            orders = Order.all()
+            app.logger.info('Returning unfiltered list.')
+
+        limit = args['limit'] or app.config['PAGE_SIZE']
+        descending = (args['sort'] or '').startswith('-')
+        sort = args['sort'].lstrip('-') if args['sort'] else None
+        after = decode_sort_key(args['next'], sort) if args['next'] else None
+        fields, items = requested_fields(args)
+        orders, more = records.page(filters, limit, after, sort, descending, fields)
+
+        # the page version is derived from the ids and versions it holds and the fields returned
+        fields_mask = request.headers.get(app.config['RESTX_MASK_HEADER'])
+        page_version = (",".join(f"{order.id}.{order.version}" for order in orders)
+                        + f";{more};{fields};{items};{fields_mask}")
+        etag = hashlib.sha1(page_version.encode()).hexdigest()
+        headers = validator_headers(etag, None)
+        if not is_not_modified(headers):
+            # the newest updated_at of the page would miss deletions and pages shifting,
+            # Last-Modified is the time of the last write or deletion of any Order
+            headers = validator_headers(etag, Order.last_modified())
+        if more:
+            headers['Link'] = next_page_link(limit, encode_sort_key(orders[-1], sort))
+        if is_not_modified(headers):
+            app.logger.info("Order list not modified")
+            return Response(status=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+        if items:
+            records.load_items(orders)
+        serialize = order_serializer(None if fields is None else tuple(fields), items)
+        app.logger.info("Returning %d orders", len(orders))
+        return Response(dumps(apply_mask([serialize(order) for order in orders])), status=status.HTTP_200_OK,
+                        headers=headers, mimetype=JSON_MEDIA_TYPE)
+
+
+    ######################################################################
+    # DELETE ORDERS BY FILTER
+    ######################################################################
+    @api.doc('delete_order_list')
+    @api.expect(delete_args, validate=True)
+    @api.response(200, 'Orders deleted')
+    @api.response(400, 'No filter was given')
+    def delete(self):
+        """
+        Deletes the Orders matching the filters
+        This endpoint removes the Orders and their items with a single statement
+        e.g:
+        curl -X DELETE 'http://localhost:8000/orders?customer_id=3&date_to=2022-02-21'
+        """
+        app.logger.info("Request to delete orders by filter")
+        args = delete_args.parse_args()
+        filters = search_filters(args)
+        if not filters and not args['all']:
+            abort(status.HTTP_400_BAD_REQUEST, 'Give a filter or all=true to delete Orders.')
 
-        results = [order.serialize() for order in orders]
-        app.logger.info("Returning %d orders", len(results))
-        return results, status.HTTP_200_OK
+        count = Order.delete_where(**filters)
+        app.logger.info("Deleted %d orders.", count)
+        return {'deleted': count}, status.HTTP_200_OK
 
 
     ######################################################################
     # ADD A NEW Order
     ######################################################################
     @api.doc('create_orders')
-    @api.response(400, 'The posted data was not valid')
+    @api.doc(params={'Idempotency-Key': {'in': 'header', 'type': 'string',
+                                         'description': 'Makes retries of the request return the Order created first'}})
+    @api.response(400, 'The posted data or the Idempotency-Key was not valid')
+    @api.response(422, 'The Idempotency-Key was already used for a different request')
     @api.expect(create_model)
     @api.marshal_with(order_model, code=201)
     def post(self):
@@ -292,19 +573,283 @@ class OrderCollection(Resource):
         """
         app.logger.info("Request to create an order")
         # check_content_type("application/json")
+        key = request.headers.get('Idempotency-Key')
+        if key is not None:
+            check_idempotency_key(key)
+            request_hash = IdempotencyKey.hash_request(api.payload)
+            stored = IdempotencyKey.lookup(key)
+            if stored is not None:
+                return replay_order(stored, request_hash)
+
         order = Order()
         
         app.logger.debug('Payload = %s', api.payload)
         order.deserialize(api.payload)
-        order.create()
-        message = order.serialize()
-        location_url = api.url_for(OrderResource, id=order.id, _external=True)
+        if key is None:
+            order.create()
+            message = order.serialize()
+        else:
+            expires_at = datetime.utcnow() + timedelta(seconds=app.config['IDEMPOTENCY_KEY_TTL'])
+            record = IdempotencyKey(key=key, request_hash=request_hash, expires_at=expires_at)
+            try:
+                order.create(record)
+            except IntegrityError:
+                # a concurrent request with the same key committed first
+                stored = IdempotencyKey.lookup(key)
+                if stored is None:
+                    raise
+                return replay_order(stored, request_hash)
+            message = record.body
+        location_url = api.url_for(OrderResource, id=message['id'], _external=True)
 
-        app.logger.info("Order with ID [%s] created.", order.id)
+        app.logger.info("Order with ID [%s] created.", message['id'])
         
         return message, status.HTTP_201_CREATED, {"Location": location_url}
 
 
+######################################################################
+#  PATH: /orders/lookup
+######################################################################
+lookup_model = api.model('OrderLookup', {
+    'ids': fields.List(fields.Integer, required=True, description='The ids of the Orders to return'),
+})
+
+lookup_result_model = api.model('OrderLookupResult', {
+    'orders': fields.List(fields.Nested(order_model), description='The Orders found, in request order'),
+    'missing': fields.List(fields.Integer, description='The requested ids that do not exist'),
+})
+
+
+@api.route('/orders/lookup')
+class OrderLookup(Resource):
+    """ Returns many Orders by id in one request """
+
+    @api.doc('lookup_orders')
+    @api.expect(lookup_model)
+    @api.response(200, 'Success', lookup_result_model)
+    @api.response(400, 'The ids were not a list of Order ids')
+    @api.response(413, 'Too many ids in one lookup')
+    @read_only
+    def post(self):
+        """
+        Looks up Orders by id
+        This endpoint returns the Orders with the posted ids in the order they
+        were asked for and lists the ids that were not found
+        e.g:
+        curl --location --request POST 'http://localhost:8000/orders/lookup' \
+            --header 'Content-Type: application/json' \
+            --data-raw '{"ids": [3, 1, 2]}'
+        """
+        body = request.get_json(silent=True)
+        ids = body.get('ids') if isinstance(body, dict) else None
+        if not isinstance(ids, list) or not all(
+                isinstance(id, int) and not isinstance(id, bool) and INTEGER_MIN <= id <= INTEGER_MAX for id in ids):
+            abort(status.HTTP_400_BAD_REQUEST, 'The body must hold a list of Order ids.')
+        if len(ids) > app.config['MAX_LOOKUP_SIZE']:
+            abort(status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                  f"A lookup holds at most {app.config['MAX_LOOKUP_SIZE']} ids.")
+        app.logger.info("Request to look up %d orders", len(ids))
+
+        ids = list(dict.fromkeys(ids))  # drop repeated ids, keep the request order
+        found = Order.find_many(ids)
+        serialize = order_serializer()
+        orders = [serialize(found[id]) for id in ids if id in found]
+        missing = [id for id in ids if id not in found]
+        app.logger.info("Returning %d orders, %d missing", len(orders), len(missing))
+        return Response(dumps({'orders': orders, 'missing': missing}), status=status.HTTP_200_OK,
+                        mimetype=JSON_MEDIA_TYPE)
+
+
+######################################################################
+#  PATH: /orders/batch
+######################################################################
+@api.route('/orders/batch')
+class OrderBatch(Resource):
+    """ Creates many Orders in one request """
+
+    @api.doc('create_order_batch')
+    @api.expect([create_model])
+    @api.response(201, 'Every Order was created')
+    @api.response(207, 'Some of the Orders could not be created')
+    @api.response(400, 'None of the Orders could be created')
+    @api.response(413, 'Too many Orders in one batch')
+    def post(self):
+        """
+        Creates a batch of Orders
+        This endpoint takes a JSON array of Orders, or one Order per line when
+        the Content-Type is application/x-ndjson, and reports the id or the
+        error of every element in the order they were sent
+        e.g:
+        curl --location --request POST 'http://localhost:8000/orders/batch' \
+            --header 'Content-Type: application/json' \
+            --data-raw '[{"date_order":"02/21/2022", "customer_id":"3"},
+                         {"date_order":"02/22/2022", "customer_id":"4"}]'
+        """
+        app.logger.info("Request to create a batch of orders")
+        if request.mimetype == NDJSON_MEDIA_TYPE:
+            data_list = [parse_json_line(line) for line in request.get_data(as_text=True).splitlines() if line.strip()]
+        else:
+            data_list = request.get_json(silent=True)
+            if not isinstance(data_list, list):
+                abort(status.HTTP_400_BAD_REQUEST, 'The body must be a JSON array of Orders.')
+        if len(data_list) > app.config['MAX_BATCH_SIZE']:
+            abort(status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                  f"A batch holds at most {app.config['MAX_BATCH_SIZE']} Orders.")
+
+        results = [dict(result, index=index) for index, result in enumerate(Order.create_many(data_list))]
+        created = sum(1 for result in results if 'id' in result)
+        failed = len(results) - created
+        app.logger.info("Created %d orders, %d failed.", created, failed)
+
+        if not failed:
+            code = status.HTTP_201_CREATED
+        elif created:
+            code = status.HTTP_207_MULTI_STATUS
+        else:
+            code = status.HTTP_400_BAD_REQUEST
+        return {'created': created, 'failed': failed, 'results': results}, code
+
+
+######################################################################
+#  PATH: /orders/export
+######################################################################
+@api.route('/orders/export')
+class OrderExport(Resource):
+    """ Streams every Order as newline delimited JSON """
+
+    @api.doc('export_orders')
+    @api.produces([NDJSON_MEDIA_TYPE])
+    @api.response(200, 'One Order with its items per line', order_model)
+    def get(self):
+        """
+        Exports all of the Orders
+        This endpoint streams one JSON Order per line so memory stays flat
+        however many Orders are stored
+        e.g:
+        curl 'http://localhost:8000/orders/export'
+        """
+        app.logger.info("Request to export all orders")
+        orders = records.stream(app.config['EXPORT_BATCH_SIZE'])
+        serialize = order_serializer()
+
+        def generate():
+            for order in orders:
+                yield dumps(serialize(order)) + b"\n"
+
+        return Response(stream_with_context(generate()), mimetype=NDJSON_MEDIA_TYPE)
+
+
+######################################################################
+#  PATH: /events
+######################################################################
+@api.route('/events')
+class EventCollection(Resource):
+    """ Cursor over the outbox of Order change events """
+
+    @api.doc('list_events')
+    @api.expect(event_args, validate=True)
+    @api.response(400, 'The wait is negative')
+    @api.response(410, 'The event after which to read was purged')
+    @api.response(503, 'Too many requests are waiting for events, see Retry-After')
+    @api.marshal_list_with(event_model)
+    def get(self):
+        """
+        Returns the change events that follow an event, oldest first
+        With wait the request is held until an event arrives or the wait
+        is over, the id of the last event is the next value of after
+        e.g:
+        curl 'http://localhost:8000/events?after=1234&wait=25'
+        """
+        args = event_args.parse_args()
+        if args['wait'] < 0:
+            abort(status.HTTP_400_BAD_REQUEST, 'wait cannot be negative.')
+        limit = args['limit'] or app.config['PAGE_SIZE']
+        wait = min(args['wait'], app.config['EVENT_STREAM_SECONDS'])
+        app.logger.info("Request for the events after %s", args['after'])
+        position = event_position(args['after'])
+        events = OrderEvent.after(position, limit)
+        if not events and wait > 0:
+            take_waiting_slot()
+            try:
+                deadline = time.monotonic() + wait
+                floor = position
+                while not events and time.monotonic() < deadline:
+                    db.session.rollback()  # gives the connection back to the pool while waiting
+                    head = event_waiters.wait_past(floor, max(deadline - time.monotonic(), 0))
+                    if head is not None:
+                        floor = head
+                        events = OrderEvent.after(position, limit)
+            finally:
+                event_waiters.release()
+        headers = {}
+        if len(events) == limit:
+            args = request.args.to_dict()
+            args.update(after=events[-1].id, limit=limit)
+            headers['Link'] = f'<{request.base_url}?{urlencode(args)}>; rel="next"'
+        app.logger.info("Returning %d events", len(events))
+        return [event.serialize() for event in events], status.HTTP_200_OK, headers
+
+
+@api.route('/events/stream')
+class EventStream(Resource):
+    """ Server-Sent Events stream of the Order change events """
+
+    @api.doc('stream_events', params={
+        'after': 'Stream the events that follow the event with this id, '
+                 'the Last-Event-ID header takes precedence',
+    })
+    @api.produces([EVENT_STREAM_MEDIA_TYPE])
+    @api.response(410, 'The event after which to stream was purged')
+    @api.response(503, 'Too many requests are waiting for events, see Retry-After')
+    def get(self):
+        """
+        Streams the change events as they are written
+        The stream ends after EVENT_STREAM_SECONDS, an EventSource
+        reconnects by itself and resumes after the last event it received
+        e.g:
+        curl -N 'http://localhost:8000/events/stream?after=1234'
+        """
+        after = request.headers.get('Last-Event-ID') or request.args.get('after') or '0'
+        if not after.isdigit():
+            abort(status.HTTP_400_BAD_REQUEST, 'The event id must be a natural number.')
+        app.logger.info("Request to stream the events after %s", after)
+        position = event_position(int(after))
+        limit = app.config['PAGE_SIZE']
+        poll = app.config['EVENT_POLL_SECONDS']
+        deadline = time.monotonic() + app.config['EVENT_STREAM_SECONDS']
+        take_waiting_slot()
+
+        def generate(position):
+            yield f"retry: {int(poll * 1000)}\n\n"
+            floor = position
+            while True:
+                events = OrderEvent.after(position, limit)
+                if events:
+                    position = (events[-1].txid, events[-1].id)
+                    messages = "".join(server_sent_event(event) for event in events)
+                db.session.rollback()  # never hold a connection while the client reads
+                if events:
+                    yield messages
+                    if len(events) == limit:
+                        continue
+                floor = max(floor, position)
+                while True:  # until the outbox head moves past what was sent
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        return
+                    head = event_waiters.wait_past(floor, min(EVENT_KEEP_ALIVE_SECONDS, remaining))
+                    if head is not None:
+                        floor = head
+                        break
+                    yield ": keep-alive\n\n"
+
+        headers = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+        response = Response(stream_with_context(generate(position)),
+                            mimetype=EVENT_STREAM_MEDIA_TYPE, headers=headers)
+        response.call_on_close(event_waiters.release)
+        return response
+
+
 ######################################################################
 #  PATH: /orders/{id}/items
 ######################################################################
@@ -314,27 +859,267 @@ class OrderCollection(Resource):
 class OrderItemResource(Resource):
     # @app.route("/orders/<int:id>/items", methods=["PUT"])
     @api.doc('get_order_items')
-    @api.marshal_with(item_model)
+    @api.expect(item_args, validate=True)
+    @api.marshal_list_with(item_model)
     @api.response(404, 'Order not found')
+    @read_only
     def get(self, id):
+        """
+        Returns a page of the items of an Order in id order
+        The next page is linked in the Link header, so large Orders are
+        read a page at a time
+        e.g:
+        curl 'http://localhost:8000/orders/1/items?product_id=7&limit=500'
+        """
         app.logger.info("Request to see order items with id: %s", id)
-        order = Order.find(id)
-        if not order:
-            abort(status.HTTP_404_NOT_FOUND, 'Order with id [{}] was not found.'.format(id))
-        
-        # order.id = id
-        # for item in order.items:
-        #     item.update()
-        
-        # app.logger.info("Order items for order with ID [%s] updated.", order.id)
-        return [item.serialize() for item in order.items], status.HTTP_200_OK
-        # return order.serialize(), status.HTTP_200_OK
+        args = item_args.parse_args()
+        key = order_key(id)
+        limit = args['limit'] or app.config['PAGE_SIZE']
+        after = decode_cursor(args['next'], int)[0] if args['next'] else None
+        min_price, max_price = (None if args[name] is None else Decimal(str(args[name]))
+                                for name in ('min_price', 'max_price'))
+        items, more = OrderItem.page(key, limit, after, args['product_id'], min_price, max_price)
+        if not items:
+            check_valid_order(key)  # an empty page of an Order that does not exist is a 404
+        headers = {}
+        if more:
+            headers['Link'] = next_page_link(limit, [items[-1].id])
+        app.logger.info("Returning %d items of order %s", len(items), key)
+        return [item.serialize() for item in items], status.HTTP_200_OK, headers
+
+    @api.doc('add_order_item', params=IF_MATCH_PARAM)
+    @api.response(400, 'The posted item was not valid')
+    @api.response(404, 'Order not found')
+    @api.response(412, 'The Order changed since the ETag in If-Match')
+    @api.expect(create_item_model)
+    @api.marshal_with(item_model, code=201)
+    def post(self, id):
+        """
+        Adds an item to an Order
+        Only the new item row is written, the Order totals are adjusted
+        e.g:
+        curl -X POST -d '{"product_id": 1, "product_price": 2.5, "product_quantity": 3}'
+             'http://localhost:8000/orders/1/items'
+        """
+        app.logger.info("Request to add an item to order with id: %s", id)
+        order = check_valid_order(order_key(id))
+        item, version = OrderItem.add(order.id, api.payload, matched_version(order))
+        app.logger.info("Item with ID [%s] added to order [%s].", item['id'], order.id)
+        location_url = api.url_for(OrderItemLineResource, id=order.id, item_id=item['id'], _external=True)
+        headers = {'Location': location_url, 'ETag': quote_etag(f"{order.id}.{version}")}
+        return item, status.HTTP_201_CREATED, headers
+
+
+######################################################################
+#  PATH: /orders/{id}/items/{item_id}
+######################################################################
+@api.route('/orders/<id>/items/<int:item_id>')
+@api.param('id', 'The Order identifier')
+@api.param('item_id', 'The item identifier')
+class OrderItemLineResource(Resource):
+    """ One item of an Order, written without touching the other items """
+
+    @api.doc('patch_order_item', params=IF_MATCH_PARAM)
+    @api.response(400, 'The posted values were not valid')
+    @api.response(404, 'Order or item not found')
+    @api.response(412, 'The Order changed since the ETag in If-Match')
+    @api.expect(patch_item_model)
+    @api.marshal_with(item_model)
+    def patch(self, id, item_id):
+        """
+        Changes some values of an item
+        The values left out of the body keep their stored value
+        e.g:
+        curl -X PATCH -d '{"product_quantity": 5}' 'http://localhost:8000/orders/1/items/7'
+        """
+        app.logger.info("Request to change item %s of order with id: %s", item_id, id)
+        if not isinstance(api.payload, dict):
+            raise DataValidationError("Invalid product: body of request contained bad or no data")
+        order = check_valid_order(order_key(id))
+        changed = OrderItem.change(order.id, item_id, api.payload, matched_version(order))
+        if changed is None:
+            abort(status.HTTP_404_NOT_FOUND, f'Order [{order.id}] has no item with id [{item_id}].')
+        item, version = changed
+        app.logger.info("Item with ID [%s] of order [%s] changed.", item_id, order.id)
+        return item, status.HTTP_200_OK, {'ETag': quote_etag(f"{order.id}.{version}")}
+
+    @api.doc('delete_order_item', params=IF_MATCH_PARAM)
+    @api.response(204, 'Item deleted')
+    @api.response(404, 'Order or item not found')
+    @api.response(412, 'The Order changed since the ETag in If-Match')
+    def delete(self, id, item_id):
+        """
+        Removes an item from an Order
+        e.g:
+        curl -X DELETE 'http://localhost:8000/orders/1/items/7'
+        """
+        app.logger.info("Request to remove item %s of order with id: %s", item_id, id)
+        order = check_valid_order(order_key(id))
+        version = OrderItem.remove(order.id, item_id, matched_version(order))
+        if version is None:
+            abort(status.HTTP_404_NOT_FOUND, f'Order [{order.id}] has no item with id [{item_id}].')
+        app.logger.info("Item with ID [%s] of order [%s] removed.", item_id, order.id)
+        return "", status.HTTP_204_NO_CONTENT, {'ETag': quote_etag(f"{order.id}.{version}")}
+
+
+######################################################################
+#  PATH: /stats
+######################################################################
+stats_fields = {
+    'order_count': fields.Integer(description='The number of Orders'),
+    'units': fields.Integer(description='The sum of the item quantities'),
+    'revenue': fields.Float(description='The sum of the Order totals'),
+}
+
+customer_stats_model = api.model('CustomerStats', dict(
+    {'customer_id': fields.Integer(description='The id of the customer')}, **stats_fields
+))
+
+daily_stats_model = api.model('DailyStats', dict(
+    {'day': fields.Date(description='The calendar day the Orders were placed')}, **stats_fields
+))
+
+daily_stats_args = reqparse.RequestParser()
+daily_stats_args.add_argument('from', type=str, required=False, help='The first day to return')
+daily_stats_args.add_argument('to', type=str, required=False, help='The last day to return')
+
+
+@api.route('/stats/customers/<int:customer_id>')
+@api.param('customer_id', 'The customer identifier')
+class CustomerStatsResource(Resource):
+    """ Sales figures of one customer, read from the customer rollup """
+
+    @api.doc('get_customer_stats')
+    @api.response(404, 'The customer has no Orders')
+    @api.marshal_with(customer_stats_model)
+    @read_only
+    def get(self, customer_id):
+        """
+        Returns the order count, units and revenue of a customer
+        """
+        app.logger.info("Request for the stats of customer %s", customer_id)
+        stats = CustomerStats.find(customer_id)
+        if not stats:
+            abort(status.HTTP_404_NOT_FOUND, f"Customer with id [{customer_id}] has no orders.")
+        return stats.serialize(), status.HTTP_200_OK
+
+
+@api.route('/stats/daily')
+class DailyStatsCollection(Resource):
+    """ Sales figures per calendar day, read from the daily rollup """
+
+    @api.doc('list_daily_stats')
+    @api.expect(daily_stats_args, validate=True)
+    @api.marshal_list_with(daily_stats_model)
+    @read_only
+    def get(self):
+        """
+        Returns the order count, units and revenue of each day with Orders
+        e.g:
+        curl 'http://localhost:8000/stats/daily?from=2022-02-01&to=2022-02-28'
+        """
+        args = daily_stats_args.parse_args()
+        app.logger.info("Request for the daily stats from %s to %s", args['from'], args['to'])
+        days = DailyStats.between(args['from'], args['to']).all()
+        app.logger.info("Returning %d days", len(days))
+        return [day.serialize() for day in days], status.HTTP_200_OK
+
+
+######################################################################
+#  E R R O R   H A N D L E R S
+######################################################################
+
+@api.errorhandler(DataValidationError)
+def request_validation_error(error):
+    """ Handles Value Errors from bad data """
+    message = str(error)
+    app.logger.error(message)
+    return {
+        'status_code': status.HTTP_400_BAD_REQUEST,
+        'error': 'Bad Request',
+        'message': message
+    }, status.HTTP_400_BAD_REQUEST
+
+
+@api.errorhandler(VersionConflictError)
+def version_conflict_error(error):
+    """ Handles writes based on a version of an Order that is no longer current """
+    message = str(error)
+    app.logger.warning(message)
+    return {
+        'status_code': status.HTTP_412_PRECONDITION_FAILED,
+        'error': 'Precondition Failed',
+        'message': message
+    }, status.HTTP_412_PRECONDITION_FAILED
 
 
 ######################################################################
 #  U T I L I T Y   F U N C T I O N S
 ######################################################################
 
+def validator_headers(etag, updated_at):
+    """ Returns the ETag and Last-Modified headers of a representation """
+    headers = {'ETag': quote_etag(etag)}
+    if updated_at is not None:
+        headers['Last-Modified'] = http_date(updated_at.replace(tzinfo=timezone.utc))
+    return headers
+
+
+def apply_mask(data):
+    """ Applies the X-Fields mask of the request to marshalled data like @api.marshal_with does """
+    fields_mask = request.headers.get(app.config['RESTX_MASK_HEADER'])
+    return mask.apply(data, fields_mask, skip=True) if fields_mask else data
+
+
+def is_not_modified(headers):
+    """ Checks the conditional GET headers of the request against the validators of a representation """
+    if request.if_none_match:
+        return request.if_none_match.contains_weak(unquote_etag(headers['ETag'])[0])
+    if request.if_modified_since and 'Last-Modified' in headers:
+        return parse_date(headers['Last-Modified']) <= request.if_modified_since
+    return False
+
+
+def matched_version(order):
+    """
+    Returns the version of an Order the If-Match header of the request
+    expects, None when the request is unconditional
+
+    Aborts with 412 when no ETag in If-Match is the one of the Order
+    """
+    if not request.if_match or request.if_match.star_tag:
+        return None
+    if not request.if_match.contains(f"{order.id}.{order.version}"):
+        abort(status.HTTP_412_PRECONDITION_FAILED,
+              f'Order with id [{order.id}] changed since the ETag in If-Match.')
+    return order.version
+
+
+def order_key(id):
+    """ Returns the numeric id of an Order taken from the path or raises NotFound """
+    try:
+        return int(id)
+    except ValueError:
+        raise NotFound(f"order with id '{id}' was not found.")
+
+
+def check_idempotency_key(key):
+    """ Aborts with 400 unless the Idempotency-Key is 1 to IDEMPOTENCY_KEY_LENGTH visible ASCII characters """
+    if not 0 < len(key) <= IDEMPOTENCY_KEY_LENGTH or not all('!' <= char <= '~' for char in key):
+        abort(status.HTTP_400_BAD_REQUEST,
+              f'The Idempotency-Key must be 1 to {IDEMPOTENCY_KEY_LENGTH} visible ASCII characters.')
+
+
+def replay_order(stored, request_hash):
+    """ Answers a retried POST /orders with the response to the first request """
+    if stored.request_hash != request_hash:
+        abort(status.HTTP_422_UNPROCESSABLE_ENTITY,
+              'The Idempotency-Key was already used for a different request.')
+    app.logger.info("Replaying the creation of order with ID [%s].", stored.order_id)
+    location_url = api.url_for(OrderResource, id=stored.order_id, _external=True)
+    return stored.replay(), status.HTTP_201_CREATED, {"Location": location_url, "Idempotent-Replayed": "true"}
+
+
 def check_valid_order(id):
     order = Order.find(id)
     if not order:
@@ -342,6 +1127,167 @@ def check_valid_order(id):
     return order
 
 
+def parse_json_line(line):
+    """ Parses one line of an NDJSON body, bad lines become None so they are reported per element """
+    try:
+        return json.loads(line)
+    except ValueError:
+        return None
+
+
+def search_filters(args):
+    """ Returns the search filters present in parsed query string arguments """
+    filters = {name: args[name] for name in SEARCH_FILTERS if args[name] is not None}
+    for name in ('min_total', 'max_total'):
+        if name in filters:
+            filters[name] = Decimal(str(filters[name]))
+    return filters
+
+
+def list_changes(args):
+    """
+    Answers GET /orders?updated_since= with the changed Orders and the
+    tombstones of the deleted ones, in (updated_at, id) order
+
+    A write that commits after a page was read can carry an earlier
+    updated_at, mirrors should start their next sync a little before the
+    last updated_at they saw.
+    """
+    if search_filters(args) or args['sort'] or args['fields'] or args['expand']:
+        abort(status.HTTP_400_BAD_REQUEST, 'updated_since cannot be combined with filters, sort or fields.')
+    since = parse_datetime(args['updated_since'])
+    if since.tzinfo is not None:
+        since = since.astimezone(timezone.utc).replace(tzinfo=None)
+    retention = timedelta(days=app.config['TOMBSTONE_RETENTION_DAYS'])
+    if since < datetime.utcnow() - retention:
+        abort(status.HTTP_410_GONE, 'Deletions that old are no longer kept, read the whole list again.')
+    app.logger.info("Returning the orders changed since %s", since)
+
+    limit = args['limit'] or app.config['PAGE_SIZE']
+    after = None
+    if args['next']:
+        updated_at, id = decode_cursor(args['next'], str, int)
+        try:
+            after = [datetime.fromisoformat(updated_at), id]
+        except ValueError:
+            abort(status.HTTP_400_BAD_REQUEST, 'Invalid page cursor.')
+    changes, more = Order.changes(since, limit, after)
+    headers = {}
+    if more:
+        updated_at, id, _ = changes[-1]
+        headers['Link'] = next_page_link(limit, [updated_at.isoformat(), id])
+    results = [
+        marshal(order.serialize(), order_model) if order is not None
+        else marshal({'id': id, 'updated_at': updated_at, 'deleted': True}, tombstone_model)
+        for updated_at, id, order in changes
+    ]
+    app.logger.info("Returning %d changes", len(results))
+    return results, status.HTTP_200_OK, headers
+
+
+def event_position(event_id):
+    """ Returns the outbox position of an event id, aborts with 410 when it was purged """
+    position = OrderEvent.position(event_id)
+    if position is None:
+        abort(status.HTTP_410_GONE, f'Event [{event_id}] is no longer kept, read the Orders again.')
+    return position
+
+
+def take_waiting_slot():
+    """ Takes one of the EVENT_MAX_WAITERS slots or aborts with 503 when they are all taken """
+    if not event_waiters.acquire(app):
+        app.logger.warning("Every event waiting slot is taken")
+        # a slot frees up when a wait ends, at the latest after EVENT_STREAM_SECONDS
+        retry_after = math.ceil(app.config['EVENT_STREAM_SECONDS'] / max(app.config['EVENT_MAX_WAITERS'], 1))
+        raise ServiceUnavailable('Too many requests are waiting for events, retry later.',
+                                 retry_after=max(retry_after, 1))
+
+
+def server_sent_event(event):
+    """ Formats an event as a Server-Sent Events message """
+    data = json.dumps(marshal(event.serialize(), event_model))
+    return f"id: {event.id}\nevent: {event.type}\ndata: {data}\n\n"
+
+
+def requested_fields(args):
+    """
+    Returns the Order fields asked for with ?fields= and ?expand= and
+    whether the items are part of them, None stands for every field
+    """
+    if args['fields'] is None:
+        return None, args['expand'] != 'none'
+    names = {name.strip() for name in args['fields'].split(',')} - {''}
+    unknown = names - set(Order.FIELDS) - {'item_list'}
+    if unknown:
+        abort(status.HTTP_400_BAD_REQUEST, f"Unknown fields: {', '.join(sorted(unknown))}.")
+    fields = [name for name in Order.FIELDS if name in names]
+    return fields, 'item_list' in names or args['expand'] == 'items'
+
+
+def fields_model(fields, items):
+    """ Returns the fields to marshal Orders with, see requested_fields() """
+    if fields is None:
+        return order_model if items else order_summary_model
+    model = {name: order_model.resolved[name] for name in fields}
+    if items:
+        model['item_list'] = order_model.resolved['item_list']
+    return model
+
+
+@lru_cache(maxsize=None)
+def order_serializer(fields=None, items=True):
+    """
+    Returns the compiled serializer of the Orders marshalled with
+    fields_model(), fields is a tuple so the serializer can be reused
+    """
+    return compile_model(fields_model(fields, items), {'item_list': 'items'})
+
+
+def encode_sort_key(order, sort):
+    """ Returns the JSON compatible sort key of the last order of a page """
+    key = Order.sort_key(order, sort)
+    if sort == 'total_amount':
+        key[0] = str(key[0])  # keeps the exact amount
+    return key
+
+
+def decode_sort_key(cursor, sort):
+    """ Returns the sort key of a page cursor for the given sort column """
+    if sort is None:
+        return decode_cursor(cursor, int)
+    if sort == 'total_amount':
+        value, id = decode_cursor(cursor, str, int)
+        try:
+            return [Decimal(value), id]
+        except ArithmeticError:
+            abort(status.HTTP_400_BAD_REQUEST, 'Invalid page cursor.')
+    return decode_cursor(cursor, int, int)
+
+
+def encode_cursor(key):
+    """ Turns the sort key of the last row of a page into an opaque cursor """
+    return base64.urlsafe_b64encode(json.dumps(key).encode()).decode()
+
+
+def decode_cursor(cursor, *types):
+    """ Returns the sort key stored in a cursor made by encode_cursor, checking its types """
+    try:
+        key = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (ValueError, TypeError):
+        key = None
+    if not isinstance(key, list) or len(key) != len(types) or not all(
+            isinstance(value, kind) for value, kind in zip(key, types)):
+        abort(status.HTTP_400_BAD_REQUEST, 'Invalid page cursor.')
+    return key
+
+
+def next_page_link(limit, key):
+    """ Builds the Link header pointing at the page after the given sort key """
+    args = request.args.to_dict(flat=False)
+    args.update(limit=[limit], next=[encode_cursor(key)])
+    return f'<{request.base_url}?{urlencode(args, doseq=True)}>; rel="next"'
+
+
 def init_db():
     """ Initializes the SQLAlchemy app """
     global app
@@ -0,0 +1,86 @@
+"""
+Compiled Serializers
+
+Turns the flask-restx models of the API into plain functions that read a
+model instance and return what marshal() would return for it. Large
+responses skip the field machinery of flask-restx this way while the
+models, and so the swagger docs, stay the single definition of the output.
+
+dumps() writes the result as JSON bytes with orjson when it is installed
+and falls back to the json module otherwise.
+"""
+import json
+from datetime import date, datetime
+from operator import attrgetter
+
+from flask_restx import fields
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+
+def dumps(data):
+    """ Returns data as compact JSON bytes """
+    if orjson is not None:
+        return orjson.dumps(data)
+    return json.dumps(data, separators=(",", ":")).encode()
+
+
+def compile_model(model, attributes=None):
+    """
+    Returns a function that serializes an object like marshal(obj, model)
+
+    Args:
+        model: a flask-restx Model or a dictionary of fields
+        attributes (dict): the attribute to read for some field names when
+            it is not the field name, applied to the nested models as well
+    """
+    attributes = attributes or {}
+    getters = []
+    for name, field in getattr(model, "resolved", model).items():
+        if isinstance(field, type):  # models may name a field class, marshal() instantiates it
+            field = field()
+        getters.append((name, attrgetter(field.attribute or attributes.get(name, name)),
+                        compile_field(field, attributes)))
+
+    def serialize(obj):
+        data = {}
+        for name, get, convert in getters:
+            value = get(obj)
+            data[name] = None if value is None else convert(value)
+        return data
+
+    return serialize
+
+
+def compile_field(field, attributes):
+    """ Returns the function that formats the value of a field """
+    if isinstance(field, fields.List) and isinstance(field.container, fields.Nested):
+        nested = compile_model(field.container.nested, attributes)
+        return lambda values: [nested(value) for value in values]
+    if isinstance(field, fields.Date):
+        return format_date
+    if isinstance(field, fields.DateTime) and field.dt_format == "iso8601":
+        return format_datetime
+    for kind, convert in ((fields.Boolean, bool), (fields.Integer, int), (fields.Float, float),
+                          (fields.String, str)):
+        if type(field) is kind:  # subclasses may format differently
+            return convert
+    # anything else goes through flask-restx, one value at a time
+    return field.format
+
+
+def format_date(value):
+    """ Formats a date or the date of a datetime like fields.Date """
+    if isinstance(value, datetime):
+        value = value.date()
+    return value.isoformat()
+
+
+def format_datetime(value):
+    """ Formats a datetime, or a date at midnight, like fields.DateTime """
+    if not isinstance(value, datetime) and isinstance(value, date):
+        value = datetime(value.year, value.month, value.day)
+    return value.isoformat()
@@ -0,0 +1,98 @@
+"""
+Test cases for the Order Cache
+
+Test cases can be run with:
+    nosetests
+    coverage report -m
+"""
+from unittest import TestCase
+
+from service.cache import CacheBackend, LRUCache, create_cache
+
+
+class FakeClock:
+    """A clock the tests can move forward"""
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+######################################################################
+#  L R U   C A C H E   T E S T   C A S E S
+######################################################################
+class TestLRUCache(TestCase):
+    """Test Cases for the in-process cache backend"""
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.cache = LRUCache(maxsize=2, ttl=10, clock=self.clock)
+
+    def test_hit_and_miss(self):
+        """Count hits and misses"""
+        self.assertIsNone(self.cache.get(1))
+        self.cache.set(1, {"id": 1})
+        self.assertEqual(self.cache.get(1), {"id": 1})
+        stats = self.cache.stats()
+        self.assertEqual(stats["hits"], 1)
+        self.assertEqual(stats["misses"], 1)
+        self.assertEqual(stats["size"], 1)
+
+    def test_entries_expire(self):
+        """Drop entries older than the ttl"""
+        self.cache.set(1, {"id": 1})
+        self.clock.now = 9.9
+        self.assertIsNotNone(self.cache.get(1))
+        self.clock.now = 10
+        self.assertIsNone(self.cache.get(1))
+        self.assertEqual(self.cache.stats()["expirations"], 1)
+        self.assertEqual(self.cache.stats()["size"], 0)
+
+    def test_least_recently_used_is_evicted(self):
+        """Evict the least recently used entry when full"""
+        self.cache.set(1, {"id": 1})
+        self.cache.set(2, {"id": 2})
+        self.cache.get(1)
+        self.cache.set(3, {"id": 3})
+        self.assertIsNone(self.cache.get(2))
+        self.assertIsNotNone(self.cache.get(1))
+        self.assertIsNotNone(self.cache.get(3))
+        self.assertEqual(self.cache.stats()["evictions"], 1)
+
+    def test_delete_and_clear(self):
+        """Invalidate single entries and the whole cache"""
+        self.cache.set(1, {"id": 1})
+        self.cache.set(2, {"id": 2})
+        self.cache.delete(1)
+        self.cache.delete(99)
+        self.assertIsNone(self.cache.get(1))
+        self.cache.clear()
+        self.assertIsNone(self.cache.get(2))
+
+    def test_zero_size_disables_caching(self):
+        """Store nothing when maxsize is 0"""
+        cache = LRUCache(maxsize=0)
+        cache.set(1, {"id": 1})
+        self.assertIsNone(cache.get(1))
+
+    def test_create_cache_from_config(self):
+        """Build the backend named in the configuration"""
+        cache = create_cache({
+            "ORDER_CACHE_BACKEND": "service.cache.LRUCache",
+            "ORDER_CACHE_SIZE": 5,
+            "ORDER_CACHE_TTL": 1,
+        })
+        self.assertIsInstance(cache, LRUCache)
+        self.assertEqual(cache.maxsize, 5)
+        self.assertEqual(cache.ttl, 1)
+
+    def test_backend_interface(self):
+        """The base backend only defines the interface"""
+        backend = CacheBackend.from_config({})
+        self.assertRaises(NotImplementedError, backend.get, 1)
+        self.assertRaises(NotImplementedError, backend.set, 1, {})
+        self.assertRaises(NotImplementedError, backend.delete, 1)
+        self.assertRaises(NotImplementedError, backend.clear)
+        self.assertRaises(NotImplementedError, backend.stats)
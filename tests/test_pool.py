@@ -0,0 +1,68 @@
+"""
+Test cases for the Connection Pool helpers
+
+Test cases can be run with:
+    nosetests
+    coverage report -m
+"""
+import sqlite3
+from unittest import TestCase
+
+from sqlalchemy import exc
+from sqlalchemy.pool import NullPool
+
+from service.pool import InstrumentedQueuePool, engine_options, pool_stats
+
+CONFIG = {
+    "DB_POOL_SIZE": 3,
+    "DB_MAX_OVERFLOW": 2,
+    "DB_POOL_TIMEOUT": 5,
+    "DB_POOL_RECYCLE": 60,
+    "DB_POOL_PRE_PING": True,
+}
+
+
+######################################################################
+#  P O O L   T E S T   C A S E S
+######################################################################
+class TestPool(TestCase):
+    """Test Cases for the connection pool helpers"""
+
+    def test_engine_options(self):
+        """Build the pool options from the configuration"""
+        options = engine_options(CONFIG, "postgresql://postgres@localhost/postgres")
+        self.assertIs(options["poolclass"], InstrumentedQueuePool)
+        self.assertEqual(options["pool_size"], 3)
+        self.assertEqual(options["max_overflow"], 2)
+        self.assertEqual(options["pool_timeout"], 5)
+        self.assertEqual(options["pool_recycle"], 60)
+        self.assertTrue(options["pool_pre_ping"])
+
+    def test_engine_options_sqlite(self):
+        """Leave the pool of SQLite alone"""
+        options = engine_options(CONFIG, "sqlite:///orders.db")
+        self.assertEqual(options, {"pool_pre_ping": True})
+
+    def test_pool_stats(self):
+        """Count checkouts, overflow and timeouts"""
+        pool = InstrumentedQueuePool(
+            lambda: sqlite3.connect(":memory:"), pool_size=1, max_overflow=1, timeout=0.01
+        )
+        first = pool.connect()
+        second = pool.connect()
+        self.assertRaises(exc.TimeoutError, pool.connect)
+        stats = pool_stats(pool)
+        self.assertEqual(stats["class"], "InstrumentedQueuePool")
+        self.assertEqual(stats["checked_out"], 2)
+        self.assertEqual(stats["overflow"], 1)
+        self.assertEqual(stats["checkouts"], 3)
+        self.assertEqual(stats["timeouts"], 1)
+        self.assertGreaterEqual(stats["max_wait_seconds"], 0.01)
+        first.close()
+        second.close()
+        self.assertEqual(pool_stats(pool)["checked_out"], 0)
+
+    def test_pool_stats_other_pools(self):
+        """Report only the class of pools without a queue"""
+        pool = NullPool(lambda: sqlite3.connect(":memory:"))
+        self.assertEqual(pool_stats(pool), {"class": "NullPool"})
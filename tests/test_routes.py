@@ -10,8 +10,12 @@ import logging
 import os
 from unittest import TestCase
 import json
+import threading
+import time
+from datetime import datetime
+from sqlalchemy import event
 from service import app, status  # HTTP Status Codes
-from service.models import db, init_db
+from service.models import db, init_db, Order, OrderItem, IdempotencyKey
 from tests.factories import OrderFactory, OrderWithItemsFactory
 
 # Disable all but critical errors during normal test run
@@ -51,6 +55,7 @@ class OrderTests(TestCase):
         """ This runs before each test """
         db.drop_all()  # clean up the last tests
         db.create_all()  # create new tables
+        Order.cache.clear()
         self.app = app.test_client()
         self.app = app.test_client()
 
@@ -75,6 +80,42 @@ class OrderTests(TestCase):
             orders.append(test_order)
         return orders
 
+    def _create_orders_with_items(self, count, customer_id=None):
+        """Factory method to create orders with items through the API"""
+        for _ in range(count):
+            test_order = OrderWithItemsFactory(items=3)
+            data = test_order.serialize()
+            data["item_list"] = [
+                {"product_id": item.product_id, "product_quantity": item.product_quantity,
+                 "product_price": item.product_price}
+                for item in test_order.items
+            ]
+            if customer_id is not None:
+                data["customer_id"] = customer_id
+            resp = self.app.post(BASE_URL, json=data, content_type=CONTENT_TYPE_JSON)
+            self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+
+    def _count_queries(self, url, headers=None):
+        """Issues a GET and returns the response and the number of SQL statements it ran"""
+        resp, statements = self._capture_queries(url, headers)
+        return resp, len(statements)
+
+    def _capture_queries(self, url, headers=None):
+        """Issues a GET and returns the response and the SQL statements it ran"""
+        statements = []
+
+        def count(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+
+        db.session.remove()
+        event.listen(db.engine, "before_cursor_execute", count)
+        try:
+            resp = self.app.get(url, headers=headers)
+            resp.get_data()  # run streamed bodies while counting
+        finally:
+            event.remove(db.engine, "before_cursor_execute", count)
+        return resp, statements
+
     ######################################################################
     #  P L A C E   T E S T   C A S E S   H E R E
     ######################################################################
@@ -102,6 +143,274 @@ class OrderTests(TestCase):
         data = resp.get_json()
         self.assertEqual(data["id"], test_order.id)
 
+    def test_get_order_fields_mask(self):
+        """Apply the X-Fields mask to a single Order, cached or not"""
+        self._create_orders_with_items(1)
+        order_id = self.app.get(BASE_URL).get_json()[0]["id"]
+        headers = {"X-Fields": "id,item_list{product_id}"}
+        for _ in range(2):  # the second read is served from the cache
+            data = self.app.get(f"{BASE_URL}/{order_id}", headers=headers).get_json()
+            self.assertEqual(set(data), {"id", "item_list"})
+            self.assertEqual([set(item) for item in data["item_list"]], [{"product_id"}] * 3)
+        resp = self.app.get(f"{BASE_URL}/{order_id}?expand=none", headers={"X-Fields": "id,total_amount"})
+        self.assertEqual(set(resp.get_json()), {"id", "total_amount"})
+        Order.cache.clear()
+        resp = self.app.get(f"{BASE_URL}/{order_id}?expand=none", headers={"X-Fields": "id"})
+        self.assertEqual(resp.get_json(), {"id": order_id})
+        spec = self.app.get("/swagger.json").get_json()
+        parameters = spec["paths"]["/orders/{id}"]["get"]["parameters"]
+        self.assertIn("X-Fields", [parameter["name"] for parameter in parameters])
+
+    def test_get_order_list_query_count(self):
+        """List Orders with a fixed number of queries"""
+        self._create_orders_with_items(2, customer_id=7)
+        resp, few = self._count_queries(BASE_URL)
+        self.assertEqual(len(resp.get_json()), 2)
+        self._create_orders_with_items(8, customer_id=7)
+        resp, many = self._count_queries(BASE_URL)
+        data = resp.get_json()
+        self.assertEqual(len(data), 10)
+        self.assertEqual(few, many)
+        self.assertLessEqual(many, 3)  # the page, the Last-Modified time and the items
+        for order in data:
+            self.assertEqual(len(order["item_list"]), 3)
+
+        resp, searched = self._count_queries(f"{BASE_URL}?customer_id=7")
+        self.assertEqual(len(resp.get_json()), 10)
+        self.assertEqual(searched, many)
+
+        resp, detail = self._count_queries(f"{BASE_URL}/{data[0]['id']}")
+        self.assertEqual(len(resp.get_json()["item_list"]), 3)
+        self.assertLessEqual(detail, 2)
+
+    def test_get_order_list_fields(self):
+        """List only some fields of the Orders and skip the items query"""
+        self._create_orders_with_items(3, customer_id=7)
+        resp, statements = self._capture_queries(f"{BASE_URL}?fields=id,customer_id,date_order&limit=2")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = resp.get_json()
+        self.assertEqual([set(order) for order in data], [{"id", "customer_id", "date_order"}] * 2)
+        self.assertEqual(len(statements), 2)  # the page and the Last-Modified time
+        self.assertNotIn("total_amount", statements[0])
+        url = resp.headers["Link"][1:resp.headers["Link"].index(">")]
+        self.assertEqual(len(self.app.get(url).get_json()), 1)
+
+        resp, statements = self._capture_queries(f"{BASE_URL}?fields=id&expand=items")
+        self.assertEqual([len(order["item_list"]) for order in resp.get_json()], [3, 3, 3])
+        self.assertEqual(len(statements), 3)
+        resp = self.app.get(BASE_URL, query_string={"expand": "none"})
+        self.assertNotIn("item_list", resp.get_json()[0])
+        self.assertIn("total_amount", resp.get_json()[0])
+        resp = self.app.get(f"{BASE_URL}?fields=item_list")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual([set(order) for order in resp.get_json()], [{"item_list"}] * 3)
+        resp = self.app.get(f"{BASE_URL}?fields=")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_json(), [{}] * 3)
+        resp = self.app.get(BASE_URL, query_string={"fields": "id,password"})
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_get_order_list_fields_mask(self):
+        """Apply the X-Fields mask to the Order list"""
+        self._create_orders_with_items(2)
+        full = self.app.get(BASE_URL)
+        resp = self.app.get(BASE_URL, headers={"X-Fields": "id"})
+        self.assertEqual(resp.get_json(), [{"id": order["id"]} for order in full.get_json()])
+        self.assertNotEqual(resp.headers["ETag"], full.headers["ETag"])
+        resp = self.app.get(BASE_URL, headers={"X-Fields": "customer_id,item_list{product_price}"})
+        for order in resp.get_json():
+            self.assertEqual(set(order), {"customer_id", "item_list"})
+            self.assertEqual([set(item) for item in order["item_list"]], [{"product_price"}] * 3)
+        spec = self.app.get("/swagger.json").get_json()
+        parameters = spec["paths"]["/orders"]["get"]["parameters"]
+        self.assertIn("X-Fields", [parameter["name"] for parameter in parameters])
+
+    def test_get_order_list_pages(self):
+        """Page through the list of Orders"""
+        orders = self._create_order(7)
+        seen = []
+        url = f"{BASE_URL}?limit=3"
+        while url:
+            resp = self.app.get(url)
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+            data = resp.get_json()
+            self.assertLessEqual(len(data), 3)
+            seen.extend(order["id"] for order in data)
+            link = resp.headers.get("Link")
+            url = link[1:link.index(">")] if link else None
+        self.assertEqual(seen, sorted(order.id for order in orders))
+
+    def test_get_order_list_sorted_by_total(self):
+        """Page through the Orders from the highest total down"""
+        for price in (3, 1, 2, 2):
+            data = {"customer_id": 1, "date_order": "2022-02-21",
+                    "item_list": [{"product_id": 1, "product_quantity": 1, "product_price": price}]}
+            self.assertEqual(self.app.post(BASE_URL, json=data).status_code, status.HTTP_201_CREATED)
+        seen = []
+        url = f"{BASE_URL}?limit=1&sort=-total_amount&min_items=1"
+        while url:
+            resp = self.app.get(url)
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+            seen.extend((order["total_amount"], order["item_count"]) for order in resp.get_json())
+            link = resp.headers.get("Link")
+            url = link[1:link.index(">")] if link else None
+        self.assertEqual(seen, [(3.0, 1), (2.0, 1), (2.0, 1), (1.0, 1)])
+        self.assertEqual(len(self.app.get(f"{BASE_URL}?max_total=2&sort=item_count").get_json()), 3)
+        resp = self.app.get(f"{BASE_URL}?sort=-total_amount&next=WzEsMV0=")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.get(f"{BASE_URL}?sort=customer_id")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_get_order_list_pages_by_customer(self):
+        """Page through the Orders of a customer"""
+        self._create_orders_with_items(5, customer_id=3)
+        self._create_orders_with_items(2, customer_id=4)
+        resp = self.app.get(BASE_URL, query_string="customer_id=3&limit=4")
+        self.assertEqual(len(resp.get_json()), 4)
+        link = resp.headers["Link"]
+        self.assertIn("customer_id=3", link)
+        self.assertTrue(link.endswith('rel="next"'))
+        resp = self.app.get(link[1:link.index(">")])
+        data = resp.get_json()
+        self.assertEqual(len(data), 1)
+        self.assertEqual(data[0]["customer_id"], "3")
+        self.assertNotIn("Link", resp.headers)
+
+    def test_get_order_list_bad_cursor(self):
+        """Ask for a page with a cursor that was not issued by the service"""
+        resp = self.app.get(BASE_URL, query_string="next=bogus")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.get(BASE_URL, query_string="limit=0")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_export_orders(self):
+        """Stream all Orders as NDJSON"""
+        self._create_orders_with_items(5)
+        batch_size = app.config["EXPORT_BATCH_SIZE"]
+        app.config["EXPORT_BATCH_SIZE"] = 2
+        try:
+            resp, statements = self._count_queries(f"{BASE_URL}/export")
+        finally:
+            app.config["EXPORT_BATCH_SIZE"] = batch_size
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.mimetype, "application/x-ndjson")
+        lines = resp.get_data(as_text=True).splitlines()
+        self.assertEqual(len(lines), 5)
+        orders = [json.loads(line) for line in lines]
+        self.assertEqual([order["id"] for order in orders], sorted(order["id"] for order in orders))
+        for order in orders:
+            self.assertEqual(len(order["item_list"]), 3)
+        # one query for the orders and one item query per batch of two
+        self.assertEqual(statements, 4)
+
+    def test_get_order_is_cached(self):
+        """Serve repeated reads of an Order from the cache"""
+        self._create_orders_with_items(1)
+        order_id = self.app.get(BASE_URL).get_json()[0]["id"]
+        hits = Order.cache.stats()["hits"]
+        resp, first = self._count_queries(f"{BASE_URL}/{order_id}")
+        self.assertGreater(first, 0)
+        resp, second = self._count_queries(f"{BASE_URL}/{order_id}")
+        self.assertEqual(second, 0)
+        self.assertEqual(len(resp.get_json()["item_list"]), 3)
+        stats = self.app.get("/metrics").get_json()["order_cache"]
+        self.assertEqual(stats["hits"], hits + 1)
+        self.assertEqual(stats["size"], 1)
+
+    def test_metrics(self):
+        """Report the cache and connection pool counters"""
+        resp = self.app.get("/metrics")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = resp.get_json()
+        self.assertIn("hits", data["order_cache"])
+        self.assertEqual(data["db_pool"]["class"], "InstrumentedQueuePool")
+        self.assertEqual(data["db_pool"]["size"], app.config["DB_POOL_SIZE"])
+        self.assertGreater(data["db_pool"]["checkouts"], 0)
+
+    def test_write_invalidates_cached_order(self):
+        """Re-read an Order after it is updated and deleted"""
+        self._create_orders_with_items(1)
+        order = self.app.get(f"{BASE_URL}/1").get_json()
+        order["customer_id"] = 4242
+        resp = self.app.put(f"{BASE_URL}/1", json=order, content_type=CONTENT_TYPE_JSON)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(self.app.get(f"{BASE_URL}/1").get_json()["customer_id"], "4242")
+        self.app.delete(f"{BASE_URL}/1")
+        resp = self.app.get(f"{BASE_URL}/1")
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_get_order_conditional(self):
+        """Answer conditional GETs of an Order with 304"""
+        self._create_orders_with_items(1)
+        resp = self.app.get(f"{BASE_URL}/1")
+        etag = resp.headers["ETag"]
+        last_modified = resp.headers["Last-Modified"]
+
+        Order.cache.clear()
+        for headers in ({"If-None-Match": etag}, {"If-Modified-Since": last_modified}):
+            resp = self.app.get(f"{BASE_URL}/1", headers=headers)
+            self.assertEqual(resp.status_code, status.HTTP_304_NOT_MODIFIED)
+            self.assertEqual(resp.data, b"")
+            self.assertEqual(resp.headers["ETag"], etag)
+
+        # once cached the validators are checked without touching the database
+        self.app.get(f"{BASE_URL}/1")
+        resp, statements = self._count_queries(f"{BASE_URL}/1", headers={"If-None-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(statements, 0)
+
+        order = self.app.get(f"{BASE_URL}/1").get_json()
+        order["customer_id"] = 77
+        self.app.put(f"{BASE_URL}/1", json=order, content_type=CONTENT_TYPE_JSON)
+        resp = self.app.get(f"{BASE_URL}/1", headers={"If-None-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(resp.headers["ETag"], etag)
+        self.assertEqual(resp.get_json()["customer_id"], "77")
+
+    def test_get_order_list_conditional(self):
+        """Answer conditional GETs of the Order list with 304"""
+        self._create_orders_with_items(3)
+        resp = self.app.get(BASE_URL)
+        etag = resp.headers["ETag"]
+
+        resp, statements = self._count_queries(BASE_URL, headers={"If-None-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(statements, 1)
+        resp = self.app.get(BASE_URL, headers={"If-None-Match": "W/" + etag})
+        self.assertEqual(resp.status_code, status.HTTP_304_NOT_MODIFIED)
+
+        self._create_orders_with_items(1)
+        resp = self.app.get(BASE_URL, headers={"If-None-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(resp.get_json()), 4)
+        self.assertNotEqual(resp.headers["ETag"], etag)
+
+    def test_get_order_list_conditional_after_delete(self):
+        """Answer a conditional GET of the Order list with 200 after an Order is deleted"""
+        self._create_orders_with_items(2)
+        # HTTP dates have whole seconds, the orders are written well before the deletion
+        Order.query.update({Order.updated_at: datetime(2022, 2, 21)})
+        db.session.commit()
+        resp = self.app.get(BASE_URL)
+        etag, last_modified = resp.headers["ETag"], resp.headers["Last-Modified"]
+        self.assertEqual(last_modified, "Mon, 21 Feb 2022 00:00:00 GMT")
+        resp = self.app.get(BASE_URL, headers={"If-Modified-Since": last_modified})
+        self.assertEqual(resp.status_code, status.HTTP_304_NOT_MODIFIED)
+
+        newest = max(order["id"] for order in self.app.get(BASE_URL).get_json())
+        self.assertEqual(self.app.delete(f"{BASE_URL}/{newest}").status_code, status.HTTP_204_NO_CONTENT)
+        resp = self.app.get(BASE_URL, headers={"If-Modified-Since": last_modified})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(resp.get_json()), 1)
+        self.assertNotEqual(resp.headers["Last-Modified"], last_modified)
+        resp = self.app.get(BASE_URL, headers={"If-None-Match": etag, "If-Modified-Since": last_modified})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+
+    def test_get_order_bad_id(self):
+        """Get an order with an id that is not a number"""
+        resp = self.app.get(f"{BASE_URL}/abc")
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+
     def test_get_order_not_found(self):
         """Get an order that is not found"""
         resp = self.app.get("/orders/0")
@@ -144,6 +453,196 @@ class OrderTests(TestCase):
             new_order["customer_id"], str(test_order.customer_id), "Customer id does not match"
         )
 
+    def test_create_order_with_bad_item(self):
+        """Create an order with an invalid item"""
+        test_order = OrderFactory().serialize()
+        test_order["item_list"] = [
+            {"product_id": 1, "product_quantity": 3, "product_price": 5},
+            {"product_id": 2, "product_price": 5},
+        ]
+        resp = self.app.post(BASE_URL, json=test_order, content_type=CONTENT_TYPE_JSON)
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.get(BASE_URL)
+        self.assertEqual(len(resp.get_json()), 0)
+
+    def test_create_order_idempotent(self):
+        """Retry a create with the same Idempotency-Key"""
+        test_order = OrderWithItemsFactory(items=2).serialize()
+        test_order["item_list"] = [{"product_id": 1, "product_quantity": 2, "product_price": 3}]
+        headers = {"Idempotency-Key": "retry-1"}
+        resp = self.app.post(BASE_URL, json=test_order, headers=headers, content_type=CONTENT_TYPE_JSON)
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        first = resp.get_json()
+
+        statements = []
+
+        def count(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+
+        event.listen(db.engine, "before_cursor_execute", count)
+        try:
+            resp = self.app.post(BASE_URL, json=test_order, headers=headers, content_type=CONTENT_TYPE_JSON)
+        finally:
+            event.remove(db.engine, "before_cursor_execute", count)
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(resp.get_json(), first)
+        self.assertEqual(resp.headers["Idempotent-Replayed"], "true")
+        self.assertEqual(resp.headers["Location"], f"http://localhost/orders/{first['id']}")
+        # the replay only reads the key
+        self.assertEqual(len(statements), 1)
+        self.assertIn("idempotency_key", statements[0])
+        self.assertEqual(Order.query.count(), 1)
+
+        # the same key with another body is refused
+        test_order["customer_id"] = test_order["customer_id"] + 1
+        resp = self.app.post(BASE_URL, json=test_order, headers=headers, content_type=CONTENT_TYPE_JSON)
+        self.assertEqual(resp.status_code, status.HTTP_422_UNPROCESSABLE_ENTITY)
+        self.assertEqual(Order.query.count(), 1)
+        self.assertGreaterEqual(self.app.get("/metrics").get_json()["idempotency"]["replays"], 1)
+
+    def test_create_order_idempotency_key_expires(self):
+        """Create a new order once the Idempotency-Key expired"""
+        test_order = OrderFactory().serialize()
+        headers = {"Idempotency-Key": "retry-2"}
+        ttl = app.config["IDEMPOTENCY_KEY_TTL"]
+        app.config["IDEMPOTENCY_KEY_TTL"] = -1
+        try:
+            resp = self.app.post(BASE_URL, json=test_order, headers=headers, content_type=CONTENT_TYPE_JSON)
+            self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+            IdempotencyKey.next_purge = 0
+            resp = self.app.post(BASE_URL, json=test_order, headers=headers, content_type=CONTENT_TYPE_JSON)
+            self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+            self.assertNotIn("Idempotent-Replayed", resp.headers)
+        finally:
+            app.config["IDEMPOTENCY_KEY_TTL"] = ttl
+        self.assertEqual(Order.query.count(), 2)
+        # the expired key was replaced by the second request
+        self.assertEqual(IdempotencyKey.query.count(), 1)
+
+    def test_create_order_bad_idempotency_key(self):
+        """Reject an Idempotency-Key that is too long or not visible ASCII"""
+        test_order = OrderFactory().serialize()
+        for key in ("k" * 256, "", "two words", "caf\u00e9"):
+            resp = self.app.post(BASE_URL, json=test_order, headers={"Idempotency-Key": key},
+                                 content_type=CONTENT_TYPE_JSON)
+            self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.post(BASE_URL, json=test_order, headers={"Idempotency-Key": "k" * 255},
+                             content_type=CONTENT_TYPE_JSON)
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(len(Order.all()), 1)
+
+    def test_create_order_reuses_expired_key_before_purge(self):
+        """Reuse an expired Idempotency-Key before the expired keys are swept"""
+        test_order = OrderFactory().serialize()
+        headers = {"Idempotency-Key": "retry-3"}
+        ttl = app.config["IDEMPOTENCY_KEY_TTL"]
+        app.config["IDEMPOTENCY_KEY_TTL"] = -1
+        try:
+            resp = self.app.post(BASE_URL, json=test_order, headers=headers, content_type=CONTENT_TYPE_JSON)
+            self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+            IdempotencyKey.next_purge = float("inf")  # the sweep is not due
+            resp = self.app.post(BASE_URL, json=test_order, headers=headers, content_type=CONTENT_TYPE_JSON)
+            self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+            self.assertNotIn("Idempotent-Replayed", resp.headers)
+        finally:
+            app.config["IDEMPOTENCY_KEY_TTL"] = ttl
+            IdempotencyKey.next_purge = 0
+        self.assertEqual(Order.query.count(), 2)
+        self.assertEqual(IdempotencyKey.query.count(), 1)
+
+    def test_create_order_batch(self):
+        """Create a batch of orders and report each result"""
+        batch = [
+            {"customer_id": 1, "date_order": "2022-02-21", "item_list": [
+                {"product_id": 1, "product_quantity": 2, "product_price": 5},
+                {"product_id": 2, "product_quantity": 1, "product_price": 3.5}]},
+            {"customer_id": 2, "date_order": "02/22/2022"},
+            {"customer_id": 3},
+            {"customer_id": 4, "date_order": "2022-02-23T10:30:00", "item_list": [{"product_id": 3}]},
+            {"customer_id": 5, "date_order": "2022-02-24", "item_list": [
+                {"product_id": 4, "product_quantity": 1, "product_price": 1}]},
+        ]
+        resp = self.app.post(f"{BASE_URL}/batch", json=batch, content_type=CONTENT_TYPE_JSON)
+        self.assertEqual(resp.status_code, status.HTTP_207_MULTI_STATUS)
+        data = resp.get_json()
+        self.assertEqual((data["created"], data["failed"]), (3, 2))
+        results = data["results"]
+        self.assertEqual([result["index"] for result in results], [0, 1, 2, 3, 4])
+        self.assertIn("missing date_order", results[2]["error"])
+        self.assertIn("Invalid product: missing", results[3]["error"])
+
+        order = self.app.get(f"{BASE_URL}/{results[0]['id']}").get_json()
+        self.assertEqual(order["customer_id"], "1")
+        self.assertEqual(order["date_order"], "2022-02-21")
+        self.assertEqual(sorted(item["product_price"] for item in order["item_list"]), [3.5, 5.0])
+        order = self.app.get(f"{BASE_URL}/{results[1]['id']}").get_json()
+        self.assertEqual(order["date_order"], "2022-02-22")
+        self.assertEqual(len(self.app.get(BASE_URL).get_json()), 3)
+
+    def test_create_order_batch_ndjson(self):
+        """Create a batch of orders sent as NDJSON"""
+        lines = [json.dumps({"customer_id": n, "date_order": "2022-02-21"}) for n in range(4)]
+        resp = self.app.post(f"{BASE_URL}/batch", data="\n".join(lines) + "\n", content_type="application/x-ndjson")
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(resp.get_json()["created"], 4)
+
+        resp = self.app.post(f"{BASE_URL}/batch", data="{not json\n", content_type="application/x-ndjson")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(resp.get_json()["failed"], 1)
+
+    def test_create_order_batch_bad_body(self):
+        """Reject batches that are not arrays or are too large"""
+        resp = self.app.post(f"{BASE_URL}/batch", json={"customer_id": 1}, content_type=CONTENT_TYPE_JSON)
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        max_batch_size = app.config["MAX_BATCH_SIZE"]
+        app.config["MAX_BATCH_SIZE"] = 2
+        try:
+            resp = self.app.post(f"{BASE_URL}/batch", json=[{}, {}, {}], content_type=CONTENT_TYPE_JSON)
+        finally:
+            app.config["MAX_BATCH_SIZE"] = max_batch_size
+        self.assertEqual(resp.status_code, status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+
+    def test_lookup_orders(self):
+        """Look up many orders by id in request order"""
+        self._create_orders_with_items(3)
+        ids = [int(order["id"]) for order in self.app.get(BASE_URL).get_json()]
+        statements = []
+
+        def count(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+
+        db.session.remove()
+        event.listen(db.engine, "before_cursor_execute", count)
+        try:
+            resp = self.app.post(f"{BASE_URL}/lookup", json={"ids": [ids[2], 0, ids[0], ids[2]]},
+                                 content_type=CONTENT_TYPE_JSON)
+        finally:
+            event.remove(db.engine, "before_cursor_execute", count)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = resp.get_json()
+        self.assertEqual([int(order["id"]) for order in data["orders"]], [ids[2], ids[0]])
+        self.assertEqual(len(data["orders"][0]["item_list"]), 3)
+        self.assertEqual(data["missing"], [0])
+        # one query for the orders and one for their items
+        self.assertEqual(len(statements), 2)
+
+    def test_lookup_orders_bad_body(self):
+        """Reject lookups without a list of ids, with ids out of range or with too many ids"""
+        resp = self.app.post(f"{BASE_URL}/lookup", json={"ids": "1,2"}, content_type=CONTENT_TYPE_JSON)
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.post(f"{BASE_URL}/lookup", json=[1, 2], content_type=CONTENT_TYPE_JSON)
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        for id in (10 ** 30, 2 ** 31, -2 ** 31 - 1):
+            resp = self.app.post(f"{BASE_URL}/lookup", json={"ids": [1, id]}, content_type=CONTENT_TYPE_JSON)
+            self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        max_lookup_size = app.config["MAX_LOOKUP_SIZE"]
+        app.config["MAX_LOOKUP_SIZE"] = 2
+        try:
+            resp = self.app.post(f"{BASE_URL}/lookup", json={"ids": [1, 2, 3]}, content_type=CONTENT_TYPE_JSON)
+        finally:
+            app.config["MAX_LOOKUP_SIZE"] = max_lookup_size
+        self.assertEqual(resp.status_code, status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+
     def test_update_order(self):
         """Update an existing order"""
         # create an order to update
@@ -166,6 +665,26 @@ class OrderTests(TestCase):
         updated_order = resp.get_json()
         self.assertEqual(updated_order["customer_id"], '99999')
 
+    def test_update_order_if_match(self):
+        """Update an order only if it has not changed since its ETag was read"""
+        order = self._create_order(1)[0]
+        resp = self.app.get(f"{BASE_URL}/{order.id}")
+        etag = resp.headers["ETag"]
+        data = resp.get_json()
+
+        data["customer_id"] = 7
+        resp = self.app.put(f"{BASE_URL}/{order.id}", json=data, headers={"If-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(resp.headers["ETag"], etag)
+        self.assertEqual(resp.headers["ETag"], self.app.get(f"{BASE_URL}/{order.id}").headers["ETag"])
+
+        data["customer_id"] = 8
+        resp = self.app.put(f"{BASE_URL}/{order.id}", json=data, headers={"If-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_412_PRECONDITION_FAILED)
+        self.assertEqual(self.app.get(f"{BASE_URL}/{order.id}").get_json()["customer_id"], "7")
+        resp = self.app.put(f"{BASE_URL}/{order.id}", json=data, headers={"If-Match": "*"})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+
     def test_delete_order(self):
         """Delete an order"""
         test_order = self._create_order(1)[0]
@@ -180,6 +699,27 @@ class OrderTests(TestCase):
         )
         self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
 
+    def test_delete_orders_by_filter(self):
+        """Delete the orders of a customer placed up to a date"""
+        for customer_id, date_order in ((1, "2022-01-10"), (1, "2022-02-10"), (1, "2022-03-10"), (2, "2022-01-10")):
+            self.app.post(
+                BASE_URL, content_type=CONTENT_TYPE_JSON,
+                json={"customer_id": customer_id, "date_order": date_order,
+                      "item_list": [{"product_id": 1, "product_quantity": 1, "product_price": 1}]}
+            )
+        resp = self.app.delete(BASE_URL, query_string="customer_id=1&date_to=2022-02-10")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_json(), {"deleted": 2})
+        remaining = self.app.get(BASE_URL).get_json()
+        self.assertEqual(sorted(order["date_order"] for order in remaining), ["2022-01-10", "2022-03-10"])
+        self.assertEqual(OrderItem.query.count(), 2)
+
+        resp = self.app.delete(BASE_URL)
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.delete(BASE_URL, query_string="all=true", content_type=CONTENT_TYPE_JSON)
+        self.assertEqual(resp.get_json(), {"deleted": 2})
+        self.assertEqual(self.app.get(BASE_URL).get_json(), [])
+
     def test_update_order_items(self):
         """Update order items"""
         test_order = OrderWithItemsFactory(items=4)
@@ -210,6 +750,24 @@ class OrderTests(TestCase):
         self.assertNotEqual(update_order['items'][0]['product_quantity'], origin_first_item_quantity)
 
 
+    def test_update_order_reports_item_changes(self):
+        """Update one item of an order"""
+        test_order = OrderFactory().serialize()
+        test_order["item_list"] = [
+            {"product_id": 1, "product_quantity": 3, "product_price": 5},
+            {"product_id": 2, "product_quantity": 1, "product_price": 4},
+        ]
+        resp = self.app.post(BASE_URL, json=test_order, content_type=CONTENT_TYPE_JSON)
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        order = resp.get_json()
+        order["item_list"][1]["product_quantity"] = 7
+
+        resp = self.app.put(f"{BASE_URL}/{order['id']}", json=order, content_type=CONTENT_TYPE_JSON)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.headers["X-Item-Changes"], "inserted=0, updated=1, deleted=0")
+        quantities = sorted(item["product_quantity"] for item in resp.get_json()["item_list"])
+        self.assertEqual(quantities, [3, 7])
+
     def test_get_order_items(self):
         test_order = OrderWithItemsFactory(items=4)
         resp = self.app.post(
@@ -224,6 +782,83 @@ class OrderTests(TestCase):
                 
         self.assertEqual(len(items.get_json()), 4)
 
+    def test_get_order_items_pages(self):
+        """Page through the items of an order, filtered by product"""
+        data = {"customer_id": 3, "date_order": "2022-02-22", "item_list": [
+            {"product_id": product_id % 3, "product_price": product_id, "product_quantity": 1}
+            for product_id in range(7)
+        ]}
+        order_url = self.app.post(BASE_URL, json=data).headers["Location"]
+
+        seen = []
+        url = f"{order_url}/items?limit=2&product_id=1&product_id=2"
+        while url:
+            resp = self.app.get(url)
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+            seen.extend(resp.get_json())
+            link = resp.headers.get("Link")
+            url = link[1:link.index(">")] if link else None
+        self.assertEqual([item["product_price"] for item in seen], [1, 2, 4, 5])
+        self.assertEqual(seen, sorted(seen, key=lambda item: int(item["id"])))
+
+        resp = self.app.get(f"{order_url}/items", query_string={"min_price": 2, "max_price": 3})
+        self.assertEqual([item["product_price"] for item in resp.get_json()], [2, 3])
+        resp = self.app.get(f"{order_url}/items", query_string={"product_id": 9})
+        self.assertEqual(resp.get_json(), [])
+        resp = self.app.get(f"{BASE_URL}/0/items")
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+        resp = self.app.get(f"{order_url}/items", query_string={"next": "bad"})
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_get_order_without_items(self):
+        """Get an order header and its item totals without its items"""
+        order = self._create_order(1)[0]
+        for _ in range(2):  # the second read is served from the cache
+            resp = self.app.get(f"{BASE_URL}/{order.id}", query_string={"expand": "none"})
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+            data = resp.get_json()
+            self.assertNotIn("item_list", data)
+            self.assertEqual(data["item_count"], len(order.items))
+            self.assertEqual(resp.headers["ETag"], self.app.get(f"{BASE_URL}/{order.id}").headers["ETag"])
+        resp = self.app.get(f"{BASE_URL}/{order.id}", query_string={"expand": "all"})
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_edit_order_items(self):
+        """Add, change and remove single items of an order"""
+        data = {"customer_id": 3, "date_order": "2022-02-22",
+                "item_list": [{"product_id": 1, "product_price": 2.5, "product_quantity": 2}]}
+        resp = self.app.post(BASE_URL, json=data)
+        order_url = resp.headers["Location"]
+        etag = self.app.get(order_url).headers["ETag"]
+
+        resp = self.app.post(f"{order_url}/items", json={"product_id": 2, "product_price": 10, "product_quantity": 1},
+                             headers={"If-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        item_url = resp.headers["Location"]
+        self.assertEqual(resp.get_json()["product_id"], 2)
+        self.assertNotEqual(resp.headers["ETag"], etag)
+        resp = self.app.post(f"{order_url}/items", json={"product_id": 3})
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.post(f"{order_url}/items", json={"product_id": 3, "product_price": 1, "product_quantity": 1},
+                             headers={"If-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_412_PRECONDITION_FAILED)
+
+        resp = self.app.patch(item_url, json={"product_quantity": 4})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual((resp.get_json()["product_price"], resp.get_json()["product_quantity"]), (10.0, 4))
+        order = self.app.get(order_url).get_json()
+        self.assertEqual((order["total_amount"], order["item_count"], order["unit_count"]), (45.0, 2, 6))
+        self.assertEqual(self.app.get("/stats/customers/3").get_json()["revenue"], 45.0)
+
+        self.assertEqual(self.app.delete(item_url).status_code, status.HTTP_204_NO_CONTENT)
+        self.assertEqual(self.app.delete(item_url).status_code, status.HTTP_404_NOT_FOUND)
+        self.assertEqual(self.app.patch(item_url, json={"product_quantity": 1}).status_code,
+                         status.HTTP_404_NOT_FOUND)
+        order = self.app.get(order_url).get_json()
+        self.assertEqual((order["total_amount"], order["item_count"], order["unit_count"]), (5.0, 1, 2))
+        self.assertEqual(self.app.get("/stats/customers/3").get_json()["units"], 2)
+        self.assertEqual(self.app.post(f"{BASE_URL}/0/items", json={}).status_code, status.HTTP_404_NOT_FOUND)
+
 
     # disabling this one until I can figure out what's going on - ELF
 
@@ -270,6 +905,232 @@ class OrderTests(TestCase):
             self.assertEqual(order["date_order"], str(test_date_order))
 
 
+    def test_query_order_list_combined_filters(self):
+        """Query orders by customer, date range, product and total together"""
+        rows = [
+            (1, "2022-02-01", [(10, 2, 5)]),
+            (1, "2022-02-15", [(10, 1, 5), (11, 1, 100)]),
+            (1, "2022-02-15", [(12, 1, 100)]),
+            (1, "2022-03-01", [(10, 10, 5)]),
+            (2, "2022-02-15", [(10, 10, 5)]),
+        ]
+        for customer_id, date_order, items in rows:
+            data = {
+                "customer_id": customer_id,
+                "date_order": date_order,
+                "item_list": [
+                    {"product_id": product_id, "product_quantity": quantity, "product_price": price}
+                    for product_id, quantity, price in items
+                ],
+            }
+            resp = self.app.post(BASE_URL, json=data, content_type=CONTENT_TYPE_JSON)
+            self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+
+        def count(query_string):
+            resp = self.app.get(BASE_URL, query_string=query_string)
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+            return len(resp.get_json())
+
+        self.assertEqual(count("customer_id=1"), 4)
+        self.assertEqual(count("customer_id=1&date_order=2022-02-15"), 2)
+        self.assertEqual(count("customer_id=1&date_from=2022-02-02&date_to=2022-03-01"), 3)
+        self.assertEqual(count("customer_id=1&date_to=2022-02-15"), 3)
+        self.assertEqual(count("customer_id=1&product_id=10"), 3)
+        self.assertEqual(count("product_id=10&min_total=50"), 3)
+        self.assertEqual(count("customer_id=1&date_from=2022-02-15&product_id=10&min_total=50"), 2)
+        self.assertEqual(count("min_total=105.01"), 0)
+
+    def test_query_order_list_bad_filter(self):
+        """Query orders with filters that cannot be parsed"""
+        resp = self.app.get(BASE_URL, query_string="date_from=someday")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.get(BASE_URL, query_string="customer_id=abc")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_get_changes_since(self):
+        """Sync the Orders changed and deleted since a time"""
+        orders = self._create_order(3)
+        since = self.app.get(f"{BASE_URL}/{orders[1].id}").get_json()["updated_at"]
+        self.assertEqual(self.app.delete(f"{BASE_URL}/{orders[1].id}").status_code, status.HTTP_204_NO_CONTENT)
+
+        seen = []
+        url = f"{BASE_URL}?limit=1&updated_since={since}"
+        while url:
+            resp = self.app.get(url)
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+            seen.extend(resp.get_json())
+            link = resp.headers.get("Link")
+            url = link[1:link.index(">")] if link else None
+        self.assertEqual([(int(change["id"]), change.get("deleted", False)) for change in seen],
+                         [(int(orders[2].id), False), (int(orders[1].id), True)])
+        self.assertEqual(seen[0]["customer_id"], str(orders[2].customer_id))
+
+        resp = self.app.get(BASE_URL, query_string={"updated_since": since, "customer_id": 1})
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.get(BASE_URL, query_string={"updated_since": "2000-01-01T00:00:00"})
+        self.assertEqual(resp.status_code, status.HTTP_410_GONE)
+        resp = self.app.get(BASE_URL, query_string={"updated_since": since, "next": "WyJ4IiwxXQ=="})
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_get_events(self):
+        """Follow the change events of the outbox"""
+        orders = self._create_order(2)
+        self.assertEqual(self.app.delete(f"{BASE_URL}/{orders[0].id}").status_code, status.HTTP_204_NO_CONTENT)
+
+        resp = self.app.get("/events", query_string={"limit": 2})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        events = resp.get_json()
+        link = resp.headers["Link"]
+        resp = self.app.get(link[1:link.index(">")])
+        events.extend(resp.get_json())
+        self.assertNotIn("Link", resp.headers)
+        self.assertEqual([(event["type"], event["order_id"]) for event in events], [
+            ("created", str(orders[0].id)), ("created", str(orders[1].id)), ("deleted", str(orders[0].id))
+        ])
+
+        resp = self.app.get("/events", query_string={"after": events[-1]["id"], "wait": 0.05})
+        self.assertEqual(resp.get_json(), [])
+        resp = self.app.get("/events", query_string={"after": events[-1]["id"] + 1})
+        self.assertEqual(resp.status_code, status.HTTP_410_GONE)
+        resp = self.app.get("/events", query_string={"wait": -1})
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_stream_events(self):
+        """Stream the change events as Server-Sent Events"""
+        orders = self._create_order(2)
+        app.config["EVENT_STREAM_SECONDS"] = 0
+        try:
+            resp = self.app.get("/events/stream")
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+            self.assertEqual(resp.mimetype, "text/event-stream")
+            messages = resp.get_data(as_text=True).split("\n\n")
+            resp.close()  # gives the waiting slot back like a WSGI server does
+            self.assertTrue(messages[0].startswith("retry: "))
+            first, second = messages[1].split("\n"), messages[2].split("\n")
+            self.assertEqual(first[1], "event: created")
+            self.assertEqual(json.loads(second[2][len("data: "):])["order_id"], str(orders[1].id))
+
+            resp = self.app.get("/events/stream", headers={"Last-Event-ID": first[0][len("id: "):]})
+            self.assertIn(f"{second[0]}\n", resp.get_data(as_text=True))
+            self.assertNotIn(f"{first[0]}\n", resp.get_data(as_text=True))
+            resp.close()
+            resp = self.app.get("/events/stream", headers={"Last-Event-ID": "last"})
+            self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        finally:
+            app.config["EVENT_STREAM_SECONDS"] = 30
+
+    def test_wait_for_events(self):
+        """Wake a waiting GET /events when another request writes an Order"""
+        app.config["EVENT_POLL_SECONDS"] = 0.05
+        writer = threading.Timer(0.2, lambda: app.test_client().post(
+            BASE_URL, json=OrderFactory().serialize(), content_type=CONTENT_TYPE_JSON))
+        try:
+            writer.start()
+            start = time.monotonic()
+            resp = self.app.get("/events", query_string={"wait": 10})
+            self.assertLess(time.monotonic() - start, 5)
+            self.assertEqual([event["type"] for event in resp.get_json()], ["created"])
+            self.assertEqual(self.app.get("/metrics").get_json()["event_waiters"]["waiting"], 0)
+        finally:
+            writer.join()
+            app.config["EVENT_POLL_SECONDS"] = 1
+
+    def test_event_waiters_are_capped(self):
+        """Answer 503 when every event waiting slot is taken"""
+        app.config["EVENT_MAX_WAITERS"] = 0
+        try:
+            resp = self.app.get("/events", query_string={"wait": 1})
+            self.assertEqual(resp.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+            self.assertIn("Retry-After", resp.headers)
+            resp = self.app.get("/events/stream")
+            self.assertEqual(resp.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+            # reading without waiting needs no slot
+            self.assertEqual(self.app.get("/events").status_code, status.HTTP_200_OK)
+        finally:
+            app.config["EVENT_MAX_WAITERS"] = 4
+        app.config["EVENT_STREAM_SECONDS"] = 0
+        try:
+            resp = self.app.get("/events/stream")
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+            resp.get_data()
+            resp.close()
+        finally:
+            app.config["EVENT_STREAM_SECONDS"] = 30
+        self.assertEqual(self.app.get("/metrics").get_json()["event_waiters"]["waiting"], 0)
+
+    def test_get_stats(self):
+        """Read the customer and daily rollups"""
+        for customer_id, date_order, quantity in ((1, "2022-02-21", 2), (1, "2022-02-22", 1), (2, "2022-02-22", 3)):
+            data = {"customer_id": customer_id, "date_order": date_order,
+                    "item_list": [{"product_id": 1, "product_quantity": quantity, "product_price": 2.5}]}
+            self.assertEqual(self.app.post(BASE_URL, json=data).status_code, status.HTTP_201_CREATED)
+
+        resp = self.app.get("/stats/customers/1")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_json(), {"customer_id": 1, "order_count": 2, "units": 3, "revenue": 7.5})
+        resp = self.app.get("/stats/customers/3")
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+
+        resp = self.app.get("/stats/daily", query_string={"from": "2022-02-22", "to": "2022-02-28"})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_json(), [{"day": "2022-02-22", "order_count": 2, "units": 4, "revenue": 10.0}])
+        self.assertEqual(len(self.app.get("/stats/daily").get_json()), 2)
+        resp = self.app.get("/stats/daily", query_string={"from": "yesterday"})
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_reads_go_to_replicas(self):
+        """Route reads round-robin to the replicas and writes to the primary"""
+        app.config["REPLICA_DATABASE_URIS"] = [DATABASE_URI, DATABASE_URI]
+        Order.init_replicas(app)
+        reads = {id(engine): [] for engine in Order.replicas}
+
+        def listener(engine):
+            return lambda *args: reads[id(engine)].append(args[2])
+
+        listeners = [(engine, listener(engine)) for engine in Order.replicas]
+        for engine, count in listeners:
+            event.listen(engine, "before_cursor_execute", count)
+        try:
+            writer = app.test_client()
+            resp = writer.post(BASE_URL, json=OrderFactory().serialize(), content_type=CONTENT_TYPE_JSON)
+            self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+            self.assertEqual(sum(map(len, reads.values())), 0)
+            order_id = resp.get_json()["id"]
+
+            # the writer reads its own writes from the primary
+            self.assertEqual(len(writer.get(BASE_URL).get_json()), 1)
+            self.assertEqual(sum(map(len, reads.values())), 0)
+
+            # everybody else reads from the replicas, one after the other
+            reader = app.test_client()
+            self.assertEqual(len(reader.get(BASE_URL).get_json()), 1)
+            self.assertEqual(reader.get(f"{BASE_URL}/{order_id}/items").status_code, status.HTTP_200_OK)
+            self.assertTrue(all(reads.values()))
+        finally:
+            for engine, count in listeners:
+                event.remove(engine, "before_cursor_execute", count)
+            db.session.remove()
+            app.config["REPLICA_DATABASE_URIS"] = []
+            Order.init_replicas(app)
+
+    def test_replica_reads_are_not_cached(self):
+        """Cache only the Orders read from the primary"""
+        self._create_orders_with_items(1)
+        order_id = self.app.get(BASE_URL).get_json()[0]["id"]
+        Order.cache.clear()
+        app.config["REPLICA_DATABASE_URIS"] = [DATABASE_URI]
+        Order.init_replicas(app)
+        try:
+            reader = app.test_client()
+            self.assertEqual(reader.get(f"{BASE_URL}/{order_id}").status_code, status.HTTP_200_OK)
+            self.assertEqual(Order.cache.stats()["size"], 0)
+        finally:
+            db.session.remove()
+            app.config["REPLICA_DATABASE_URIS"] = []
+            Order.init_replicas(app)
+        self.assertEqual(self.app.get(f"{BASE_URL}/{order_id}").status_code, status.HTTP_200_OK)
+        self.assertEqual(Order.cache.stats()["size"], 1)
+
     ######################################################################
     # Test Error Handlers
     ######################################################################
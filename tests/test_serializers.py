@@ -0,0 +1,78 @@
+"""
+Test cases for the Compiled Serializers
+
+Test cases can be run with:
+    nosetests
+    coverage report -m
+"""
+import json
+from datetime import date, datetime
+from decimal import Decimal
+from unittest import TestCase
+from unittest.mock import patch
+
+from flask_restx import fields, marshal
+
+from service import serializers
+from service.models import Order, OrderItem
+from service.routes import fields_model, order_model, order_serializer
+from service.serializers import compile_model, dumps
+
+
+def make_order(**values):
+    """Returns an unsaved Order with two items"""
+    order = Order(id=7, customer_id=3, date_order=datetime(2022, 2, 22, 10, 30), version=2,
+                  total_amount=Decimal("17.50"), item_count=2, unit_count=3,
+                  updated_at=datetime(2022, 2, 23, 8, 0, 0, 125))
+    order.items = [
+        OrderItem(id=1, product_id=5, product_price=Decimal("2.50"), product_quantity=1),
+        OrderItem(id=2, product_id=6, product_price=Decimal("7.50"), product_quantity=2),
+    ]
+    for name, value in values.items():
+        setattr(order, name, value)
+    return order
+
+
+######################################################################
+#  C O M P I L E D   S E R I A L I Z E R   T E S T   C A S E S
+######################################################################
+class TestCompiledSerializers(TestCase):
+    """Test Cases for the serializers compiled from the flask-restx models"""
+
+    def test_matches_marshal(self):
+        """Serialize an Order exactly like marshal()"""
+        for order in (make_order(), make_order(customer_id=None, updated_at=None, items=[])):
+            self.assertEqual(order_serializer()(order), marshal(order.serialize(), order_model))
+
+    def test_matches_marshal_with_fields(self):
+        """Serialize some fields of an Order exactly like marshal()"""
+        order = make_order()
+        for fields_asked, items in ((("id", "date_order"), False), (("total_amount",), True), (None, False)):
+            model = fields_model(fields_asked, items)
+            self.assertEqual(order_serializer(fields_asked, items)(order),
+                             marshal(order.serialize(items, fields_asked), model))
+        self.assertIs(order_serializer(("id",), False), order_serializer(("id",), False))
+
+    def test_field_formats(self):
+        """Format each kind of field like flask-restx"""
+        model = {
+            "day": fields.Date, "time": fields.DateTime(), "flag": fields.Boolean(),
+            "name": fields.String(attribute="label"), "raw": fields.Raw(), "tags": fields.List(fields.String),
+        }
+
+        class Record:
+            day = datetime(2022, 2, 22, 10, 30)
+            time = date(2022, 2, 22)
+            flag = 1
+            label = 42
+            raw = {"a": 1}
+            tags = [1, "b"]
+
+        self.assertEqual(compile_model(model)(Record()), marshal(Record(), model))
+
+    def test_dumps(self):
+        """Write compact JSON with and without orjson"""
+        data = [{"id": "1", "total": 2.5, "items": []}]
+        self.assertEqual(json.loads(dumps(data)), data)
+        with patch.object(serializers, "orjson", None):
+            self.assertEqual(dumps(data), b'[{"id":"1","total":2.5,"items":[]}]')